@@ -0,0 +1,226 @@
+"""
+Benchmark of the coupling overhead of the mHM component.
+
+Runs the mHM test domain in several configurations, each in a fresh process,
+and reports mHM time-steps per second, update latency percentiles and the
+peak resident memory of the process running the composition and of the
+worker process of the remote component. Results are written as JSON and
+can be compared with the results of an earlier run::
+
+    python benchmarks/benchmark.py --output new.json --compare old.json
+"""
+
+import argparse
+import json
+import platform
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from multiprocessing import get_context
+from pathlib import Path
+from time import perf_counter
+
+import finam as fm
+import mhm
+import numpy as np
+
+import finam_mhm as fm_mhm
+
+here = Path(__file__).parent
+START = datetime(1990, 1, 1)
+
+CONFIGS = {
+    "no_outputs": dict(outputs=None),
+    "all_outputs": dict(outputs="meta"),
+    "all_outputs_remote": dict(outputs="meta", remote=True),
+    "all_calc_horizon_outputs": dict(outputs="calc_horizon"),
+    "meteo_1h": dict(outputs=None, meteo_timestep=1),
+    "meteo_24h": dict(outputs=None, meteo_timestep=24),
+    "long_run": dict(outputs=None, years=4),
+}
+"""benchmark configurations."""
+
+
+class Timed:
+    """Mixin for mHM components recording the duration of every update."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.latencies = []
+
+    def _update(self):
+        start = perf_counter()
+        super()._update()
+        self.latencies.append(perf_counter() - start)
+
+
+class TimedMHM(Timed, fm_mhm.MHM):
+    """mHM component recording the duration of every update."""
+
+
+class TimedRemoteMHM(Timed, fm_mhm.RemoteMHM):
+    """Remote mHM component recording the duration of every update."""
+
+
+class Sink(fm.TimeComponent):
+    """Component pulling the selected outputs of mHM every hour."""
+
+    def __init__(self, model, outputs):
+        super().__init__()
+        self.model = model
+        self.outputs_set = outputs
+        self.names = []
+        self.time = START
+
+    def _initialize(self):
+        # output names are known after mHM was initialized
+        self.names = _output_names(self.model, self.outputs_set)
+        for name in self.names:
+            self.inputs.add(name=name, time=None, grid=None, units=None, mask=None)
+        self.create_connector()
+
+    def _connect(self, start_time):
+        self.try_connect(start_time)
+
+    def _update(self):
+        self.time += timedelta(hours=1)
+        for name in self.names:
+            self.inputs[name].pull_data(self.time)
+
+    def _next_time(self):
+        return self.time + timedelta(hours=1)
+
+
+def _output_names(model, outputs):
+    if outputs == "meta":
+        return list(fm_mhm.OUTPUT_META)
+    if outputs == "calc_horizon":
+        return [
+            name
+            for name in model.OUTPUT_NAMES
+            if name not in fm_mhm.OUTPUT_META and name not in fm_mhm.MRM_OUTPUT_META
+        ]
+    return []
+
+
+def _peak_rss(children=False):
+    """
+    Peak resident memory in MB (None if unknown).
+
+    Either of this process or of the largest joined child process.
+    """
+    try:
+        import resource
+    except ImportError:  # pragma: no cover
+        return None
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    rss = resource.getrusage(who).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return rss / 1024**2 if sys.platform == "darwin" else rss / 1024
+
+
+def run_config(domain, outputs=None, meteo_timestep=None, years=1, remote=False):
+    """Run a single benchmark configuration."""
+    end = START.replace(year=START.year + years)
+    kwargs = {}
+    if meteo_timestep is not None:
+        kwargs = dict(
+            input_names=["METEO_PRE"],
+            meteo_timestep=meteo_timestep,
+            ignore_input_grid=True,
+        )
+    model = (TimedRemoteMHM if remote else TimedMHM)(cwd=domain, **kwargs)
+    components = [model]
+    if meteo_timestep is not None:
+        unit = "mm / h" if meteo_timestep == 1 else "mm / d"
+        # synthetic precipitation on the L1 grid, known after initialization
+        meteo = fm.components.CallbackGenerator(
+            {
+                "PRE": (
+                    lambda _t: np.full(model.masks["L1"].shape, 0.1),
+                    fm.Info(time=None, grid=fm.NoGrid(2), units=unit),
+                )
+            },
+            start=START,
+            step=timedelta(hours=meteo_timestep),
+        )
+        components.append(meteo)
+    sink = Sink(model, outputs)
+    components.append(sink)
+    composition = fm.Composition(components, print_log=False)
+    for name in sink.names:
+        model.outputs[name] >> sink.inputs[name]
+    if meteo_timestep is not None:
+        meteo.outputs["PRE"] >> model.inputs["METEO_PRE"]
+
+    start = perf_counter()
+    composition.run(start_time=START, end_time=end)
+    wall_time = perf_counter() - start
+
+    latencies = np.array(model.latencies) * 1000
+    steps = len(latencies)
+    return {
+        "outputs": len(sink.names),
+        "steps": steps,
+        "wall_time_s": wall_time,
+        "steps_per_second": steps / wall_time,
+        "latency_ms": {
+            f"p{q}": float(np.percentile(latencies, q)) for q in (50, 90, 99)
+        },
+        "peak_rss_mb": _peak_rss(),
+        # mHM runs in the worker of the remote component, joined when finalizing
+        "peak_rss_worker_mb": _peak_rss(children=True) if remote else None,
+    }
+
+
+def run_benchmarks(domain, configs):
+    """Run benchmark configurations, each in a fresh process."""
+    results = {}
+    for name in configs:
+        # only one mHM instance per process
+        context = get_context("spawn")
+        with ProcessPoolExecutor(1, mp_context=context) as pool:
+            results[name] = pool.submit(run_config, domain, **CONFIGS[name]).result()
+        print(f"{name}: {results[name]['steps_per_second']:.1f} steps/s")
+    return results
+
+
+def compare(results, reference):
+    """Print the relative change of throughput compared to reference results."""
+    for name, result in results.items():
+        if name not in reference:
+            continue
+        ref = reference[name]["steps_per_second"]
+        change = result["steps_per_second"] / ref - 1
+        print(f"{name}: {change:+.1%} steps/s")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--domain", type=Path, default=here / "test_domain")
+    parser.add_argument("--output", type=Path, default=here / "results.json")
+    parser.add_argument("--compare", type=Path, default=None)
+    parser.add_argument("--configs", nargs="+", default=list(CONFIGS))
+    args = parser.parse_args(argv)
+
+    if not args.domain.exists():
+        mhm.download_test(path=args.domain)
+    results = {
+        "meta": {
+            "date": datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "finam_mhm": fm_mhm.__version__,
+            "finam": fm.__version__,
+            "mhm": mhm.__version__,
+        },
+        "results": run_benchmarks(args.domain.resolve(), args.configs),
+    }
+    args.output.write_text(json.dumps(results, indent=2), encoding="utf-8")
+    if args.compare is not None:
+        reference = json.loads(args.compare.read_text(encoding="utf-8"))
+        compare(results["results"], reference["results"])
+
+
+if __name__ == "__main__":
+    main()
@@ -17,17 +17,31 @@ test_domain = here / "test_domain"
 shutil.rmtree(test_domain, ignore_errors=True)
 download_test(path=test_domain)
 
-mhm = fm_mhm.MHM(cwd=test_domain)
+# daily means of the hourly values are calculated by mHM,
+# so mHM only needs to be coupled once a day
+day = timedelta(days=1)
+daily_mean = ("mean", day)
+mhm = fm_mhm.MHM(
+    cwd=test_domain,
+    coupling_step=day,
+    output=fm_mhm.OutputOptions(
+        aggregate={
+            "L1_AET_L01": daily_mean,
+            "L1_AET_L02": daily_mean,
+            "L1_AET": daily_mean,
+        },
+    ),
+)
 writer = fm_nc.NetCdfTimedWriter(
     path=here / "aet.nc",
     inputs=["AET_L01", "AET_L02", "AET"],
-    step=timedelta(days=1),
+    step=day,
 )
 
 composition = fm.Composition([mhm, writer])
 
-mhm.outputs["L1_AET_L01"] >> fm.adapters.AvgOverTime() >> writer.inputs["AET_L01"]
-mhm.outputs["L1_AET_L02"] >> fm.adapters.AvgOverTime() >> writer.inputs["AET_L02"]
-mhm.outputs["L1_AET"] >> fm.adapters.AvgOverTime() >> writer.inputs["AET"]
+mhm.outputs["L1_AET_L01"] >> writer.inputs["AET_L01"]
+mhm.outputs["L1_AET_L02"] >> writer.inputs["AET_L02"]
+mhm.outputs["L1_AET"] >> writer.inputs["AET"]
 
 composition.run(end_time=datetime(1994, 1, 1))
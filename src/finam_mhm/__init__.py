@@ -13,6 +13,27 @@ Component
    :toctree: api
 
     MHM
+    RemoteMHM
+
+Options
+=======
+
+.. autosummary::
+   :toctree: api
+
+    OutputOptions
+    MeteoOptions
+    ProfileOptions
+    RestartOptions
+    CacheOptions
+
+Ensemble
+========
+
+.. autosummary::
+   :toctree: api
+
+    MHMEnsemble
 
 Subpackages
 ===========
@@ -48,6 +69,15 @@ from .constants import (
     OUTPUT_HORIZONS_META,
     OUTPUT_META,
 )
+from .ensemble import MHMEnsemble
+from .options import (
+    CacheOptions,
+    MeteoOptions,
+    OutputOptions,
+    ProfileOptions,
+    RestartOptions,
+)
+from .remote import RemoteMHM
 
 try:
     from ._version import __version__
@@ -56,7 +86,14 @@ except ModuleNotFoundError:  # pragma: no cover
     __version__ = "0.0.0.dev0"
 
 __all__ = ["constants"]
-__all__ += ["MHM"]
+__all__ += ["MHM", "MHMEnsemble", "RemoteMHM"]
+__all__ += [
+    "CacheOptions",
+    "MeteoOptions",
+    "OutputOptions",
+    "ProfileOptions",
+    "RestartOptions",
+]
 __all__ += [
     "INPUT_UNITS",
     "MRM_OUTPUT_META",
@@ -2,49 +2,100 @@
 FINAM mHM module.
 """
 
+import copy
+import os
+import tempfile
 from datetime import datetime, timedelta
 from pathlib import Path
+from time import perf_counter
 
 import f90nml
 import finam as fm
 import mhm
+import numpy as np
 
 from .constants import (
-    HOURS_TO_TIMESTEP,
+    AGGREGATION_METHODS,
     INPUT_UNITS,
     MRM_OUTPUT_META,
-    OUTPUT_CALC,
-    OUTPUT_CALC_HORIZON,
     OUTPUT_CALC_HORIZONS_META,
     OUTPUT_CALC_META,
     OUTPUT_HORIZONS_META,
     OUTPUT_META,
 )
+from .meteo import _MeteoInputs
+from .options import _GAUGES, CacheOptions, MeteoOptions, OutputOptions, RestartOptions
+from .output import (
+    _find_cells,
+    _get_grid_name,
+    _get_points,
+    _horizon_name,
+    _is_zone,
+    _Outputs,
+    _zone_name,
+)
+from .tools import (
+    _MHM_STEP,
+    _STATE_FILES,
+    _absolute_paths,
+    _first,
+    _join_paths,
+    _MetadataCache,
+    _patch_namelist,
+    _Profiler,
+    _read_asc,
+    _read_state_time,
+)
 
 
-def _horizon_name(name, horizon):
-    return name + "_L" + str(horizon).zfill(2)
-
-
-def _get_grid_name(var):
-    grid_name = var.split("_")[0]
-    return "L1" if grid_name == "METEO" else grid_name
+def _check_input_names(input_names):
+    """Upper case names of the inputs coupled via FINAM."""
+    names = [] if input_names is None else [n.upper() for n in input_names]
+    for in_name in names:
+        if in_name not in INPUT_UNITS:
+            msg = f"mHM: input '{in_name}' is not available."
+            raise ValueError(msg)
+    return names
 
 
-def _get_var_name(var):
-    return "_".join(var.split("_")[1:])
+def _check_step(coupling_step, aggregate):
+    """Coupling step of the component checked against the aggregation intervals."""
+    step = _MHM_STEP if coupling_step is None else coupling_step
+    if step <= timedelta(0) or step % _MHM_STEP:
+        msg = (
+            "mHM: coupling step needs to be a positive multiple of one hour, "
+            f"got {step}"
+        )
+        raise ValueError(msg)
+    for name, (__, interval) in aggregate.items():
+        if interval % step:
+            msg = (
+                f"mHM: aggregation interval for '{name}' needs to be "
+                f"a multiple of the coupling step, got {interval}"
+            )
+            raise ValueError(msg)
+    return step
 
 
-def _get_meteo_inputs(inputs):
-    return {
-        _get_var_name(var).lower(): var for var in inputs if var.startswith("METEO")
-    }
+def _current_time():
+    """Current time of mHM."""
+    year, month, day, hour = mhm.run.current_time()
+    time = datetime(year=year, month=month, day=max(day, 0), hour=max(hour, 0))
+    # first time step compensate by negative values in mHM
+    if day < 0 or hour < 0:
+        time += timedelta(days=min(day, 0), hours=min(hour, 0))
+    return time
 
 
 class MHM(fm.TimeComponent):
     """
     mHM FINAM compoment.
 
+    mHM runs in the calling thread and outputs are pushed after the time-steps
+    of each update. The mHM bindings hold the GIL while stepping, so a thread
+    can't run mHM alongside the output handling. Use :class:`RemoteMHM` to
+    run the next time-step in a worker process while outputs are pushed.
+
     Parameters
     ----------
     namelist_mhm : str, optional
@@ -56,13 +107,36 @@ class MHM(fm.TimeComponent):
     namelist_mrm_output : str, optional
         path to mRM output namelist, by default "mrm_outputs.nml"
     cwd : str, optional
-        desired working directory, by default "."
+        working directory of mHM, by default ".".
+        All relative paths, in the namelists and in the arguments of the
+        component, are resolved against it on creation. The working
+        directory of the process is only changed by mHM while initializing.
     input_names : list of str, optional
         Names of input variables coupled via FINAM, by default None
     meteo_timestep : int, optional
         meteo coupling time-step in hours (1 or 24), by default None
     ignore_input_grid : bool, optional
-        use any input grid without checking compatibility, by default False
+        use any input grid without checking compatibility, by default False.
+        Otherwise, units and grids of meteo inputs are checked when connecting
+        and converted with a cached factor and cell index afterwards.
+        Meteo inputs must not be masked at active cells of L1. Flexible masks
+        are checked with the data of the first pull.
+    coupling_step : datetime.timedelta, optional
+        time-step of the component in the composition. mHM is running
+        hourly time-steps until the next coupling time and outputs are
+        only pushed once per coupling step. Needs to be a multiple of one hour,
+        by default one hour
+    output : OutputOptions, optional
+        Options for the outputs, by default None
+    meteo : MeteoOptions, optional
+        Options for the meteo inputs, by default None
+    profile : ProfileOptions, optional
+        Options to profile the component. Profiling is active if given.
+        By default None
+    restart : RestartOptions, optional
+        Options to restore and save the state of mHM, by default None
+    cache : CacheOptions, optional
+        Options to cache setup data across runs, by default None
 
     Raises
     ------
@@ -70,6 +144,16 @@ class MHM(fm.TimeComponent):
         If a given input name is invalid.
     ValueError
         If the given meteo time-step is invalid
+    ValueError
+        If the given coupling step is invalid
+    ValueError
+        If a given aggregation is invalid
+    ValueError
+        If a given zone definition is invalid
+    ValueError
+        If the state to restart from is invalid
+    ValueError
+        If a given output name matches no output
     """
 
     def __init__(
@@ -82,299 +166,457 @@ class MHM(fm.TimeComponent):
         input_names=None,
         meteo_timestep=None,
         ignore_input_grid=False,
+        coupling_step=None,
+        output=None,
+        meteo=None,
+        profile=None,
+        restart=None,
+        cache=None,
     ):
         super().__init__()
+        # all paths are resolved, so the working directory is never changed
+        self.cwd = Path(cwd).resolve()
+        self.namelist_mhm = str(self.cwd / namelist_mhm)
+        self.namelist_mhm_param = str(self.cwd / namelist_mhm_param)
+        self.namelist_mhm_output = str(self.cwd / namelist_mhm_output)
+        self.namelist_mrm_output = str(self.cwd / namelist_mrm_output)
+        output = OutputOptions() if output is None else output
+        meteo = MeteoOptions() if meteo is None else meteo
+        restart = RestartOptions() if restart is None else restart
+        cache = CacheOptions() if cache is None else cache
+        cache = _join_paths(cache, self.cwd, "metadata", "regrid")
+        if profile is not None:
+            profile = _join_paths(profile, self.cwd, "file")
+        self.profiler = _Profiler(profile)
+        self.output = _Outputs(_join_paths(output, self.cwd, "file"), self.profiler)
+        self.restart = _join_paths(restart, self.cwd, "read", "write")
+        if self.restart.read is not None:
+            _read_state_time(self.restart.read)
+        self.metadata_cache = _MetadataCache(cache.metadata, self.cwd, namelist_mhm)
+        self.config = self.metadata_cache.get(
+            "config", lambda: f90nml.read(self.namelist_mhm).todict()
+        )
+        self.INPUT_NAMES = _check_input_names(input_names)
+        self.meteo = _MeteoInputs(
+            self.INPUT_NAMES,
+            meteo_timestep,
+            _join_paths(meteo, self.cwd, "files"),
+            ignore_input_grid,
+            cache.regrid,
+        )
+        self.step = _check_step(coupling_step, output.aggregate)
         self.gridspec = {}
         self.masks = {}
         self.no_data = None
         self.number_of_horizons = None
-        self.config = f90nml.read(Path(cwd) / namelist_mhm).todict()
-        # check mrm case
-        case = self.config.get("processselection", {}).get("processcase", [])
-        mrm_set = case[7] if len(case) >= 8 else None
-        self.mrm_active = mrm_set is not None and mrm_set > 0
-        self.OUTPUT_NAMES = None
-        self.INPUT_NAMES = (
-            [] if input_names is None else [n.upper() for n in input_names]
-        )
-        for in_name in self.INPUT_NAMES:
-            if in_name not in INPUT_UNITS:
-                msg = f"mHM: input '{in_name}' is not available."
-                raise ValueError(msg)
-        self.namelist_mhm = namelist_mhm
-        self.namelist_mhm_param = namelist_mhm_param
-        self.namelist_mhm_output = namelist_mhm_output
-        self.namelist_mrm_output = namelist_mrm_output
-        self.cwd = cwd  # needed for @fm.tools.execute_in_cwd
-        # mHM always has hourly stepping
-        self.step = timedelta(hours=1)
-        self.meteo_timestep = meteo_timestep
-        self.meteo_inputs = _get_meteo_inputs(self.INPUT_NAMES)
-        self.ignore_input_grid = ignore_input_grid
-
-        if self.meteo_inputs and self.meteo_timestep not in HOURS_TO_TIMESTEP:
-            msg = (
-                "mHM: found meteo inputs but meteo time-step not valid, "
-                f"got {self.meteo_timestep}"
-            )
-            raise ValueError(msg)
 
     def _next_time(self):
         """Next pull time."""
         return self.time + self.step
 
+    @property
+    def mrm_active(self):
+        """Whether mRM is active."""
+        case = self.config.get("processselection", {}).get("processcase", [])
+        mrm_set = case[7] if len(case) >= 8 else None
+        return mrm_set is not None and mrm_set > 0
+
     @property
     def horizons(self):
         """Iterator for all horizons starting at 1."""
         return range(1, self.number_of_horizons + 1)
 
-    @fm.tools.execute_in_cwd
-    def _initialize(self):
+    @property
+    def OUTPUT_NAMES(self):
+        """Names of the outputs, None before initializing."""
+        return list(self.output.data) or None
+
+    @property
+    def output_data(self):
+        """Functions to get the compressed data of the outputs by name."""
+        return self.output.data
+
+    @property
+    def compressed_grids(self):
+        """Unstructured points at the active cells of the grids of compressed outputs."""
+        return self.output.points
+
+    @property
+    def gauge_ids(self):
+        """IDs of the evaluation gauges in the order of the gauge zone."""
+        return self.output.gauge_ids
+
+    def _init_namelist(self, directory):
+        """Path of the mHM namelist with absolute paths and restart options."""
+        # patch a copy of the cached config instead of parsing the namelist again
+        nml = f90nml.Namelist(copy.deepcopy(self.config))
+        _absolute_paths(nml, str(self.cwd))
+        if self.restart.read is not None:
+            _patch_namelist(
+                nml,
+                read_restart=True,
+                mhm_file_restartin=str(self.restart.read / _STATE_FILES["mhm"]),
+                mrm_file_restartin=str(self.restart.read / _STATE_FILES["mrm"]),
+                warming_days=0,
+            )
+            # start the evaluation period at the time of the state
+            time = _read_state_time(self.restart.read)
+            period = _first(nml["time_periods"]["eval_per"])
+            period["ystart"] = time.year
+            period["mstart"] = time.month
+            period["dstart"] = time.day
+        if self.restart.write is not None:
+            self.restart.write.mkdir(parents=True, exist_ok=True)
+            _patch_namelist(
+                nml,
+                write_restart=True,
+                mhm_file_restartout=str(self.restart.write / _STATE_FILES["mhm"]),
+                mrm_file_restartout=str(self.restart.write / _STATE_FILES["mrm"]),
+            )
+        path = Path(directory) / Path(self.namelist_mhm).name
+        nml.write(path)
+        return str(path)
+
+    def _init_mhm(self):
+        """Configure the coupling and initialize mHM without file output."""
         # only show errors
         mhm.model.set_verbosity(level=1)
         # configure coupling
-        if self.meteo_inputs:
-            kwargs = {f"meteo_expect_{var}": True for var in self.meteo_inputs}
+        if self.meteo.names:
+            kwargs = {f"meteo_expect_{var}": True for var in self.meteo.names}
             kwargs["couple_case"] = 1
-            kwargs["meteo_timestep"] = self.meteo_timestep
+            kwargs["meteo_timestep"] = self.meteo.timestep
             mhm.model.config_coupling(**kwargs)
-        # init
-        mhm.model.init(
-            namelist_mhm=self.namelist_mhm,
-            namelist_mhm_param=self.namelist_mhm_param,
-            namelist_mhm_output=self.namelist_mhm_output,
-            namelist_mrm_output=self.namelist_mrm_output,
-            cwd=".",
-        )
+        # mHM changes into its working directory when initializing
+        cwd = os.getcwd()
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                mhm.model.init(
+                    namelist_mhm=self._init_namelist(tmp),
+                    namelist_mhm_param=self.namelist_mhm_param,
+                    namelist_mhm_output=self.namelist_mhm_output,
+                    namelist_mrm_output=self.namelist_mrm_output,
+                    cwd=str(self.cwd),
+                )
+        finally:
+            os.chdir(cwd)
         # disable file output of mHM
         mhm.model.disable_output()
         mhm.run.prepare()
         # only one domain possible
         mhm.run.prepare_domain()
-        self.number_of_horizons = mhm.get.number_of_horizons()
-        # prepare outputs
-        self.OUTPUT_NAMES = list(OUTPUT_META)
-        if self.mrm_active:
-            self.OUTPUT_NAMES += list(MRM_OUTPUT_META)
-        self.OUTPUT_NAMES += [
-            _horizon_name(var, horizon)
-            for var in OUTPUT_HORIZONS_META
-            for horizon in self.horizons
-        ]
-        self.OUTPUT_NAMES += list(OUTPUT_CALC_META)
-        self.OUTPUT_NAMES += [
-            _horizon_name(var, horizon)
-            for var in OUTPUT_CALC_HORIZONS_META
-            for horizon in self.horizons
-        ]
-        # get start time
-        year, month, day, hour = mhm.run.current_time()
-        self.time = datetime(year=year, month=month, day=max(day, 0), hour=max(hour, 0))
-        # first time step compensate by negative values in mHM
-        if day < 0 or hour < 0:
-            self.time += timedelta(days=min(day, 0), hours=min(hour, 0))
 
+    def _initialize(self):
+        start = perf_counter()
+        self._init_mhm()
+        self.number_of_horizons = mhm.get.number_of_horizons()
+        # prepare outputs (name: function to get the compressed data)
+        self.output.add_variables(self.horizons, self.mrm_active)
+        self.time = _current_time()
         # store Grid specifications
-        # get grid info l0 (swap rows/cols to get "ij" indexing)
-        nrows, ncols, __, xll, yll, cell_size, no_data = mhm.get.l0_domain_info()
-        self.no_data = no_data
-        self.gridspec["L0"] = fm.EsriGrid(
-            ncols=ncols, nrows=nrows, cellsize=cell_size, xllcorner=xll, yllcorner=yll
+        self.no_data, gridspec, masks = self.metadata_cache.get(
+            "grids", self._read_grids
         )
-        self.masks["L0"] = mhm.get_mask("L0")
-        # get grid info l1 (swap rows/cols to get "ij" indexing)
-        nrows, ncols, __, xll, yll, cell_size, no_data = mhm.get.l1_domain_info()
-        self.gridspec["L1"] = fm.EsriGrid(
-            ncols=ncols, nrows=nrows, cellsize=cell_size, xllcorner=xll, yllcorner=yll
+        self.gridspec.update(gridspec)
+        self.masks.update(masks)
+        self.output.add_grids(self.masks, self.no_data)
+        if self.output.options.compressed:
+            self.output.points.update(
+                self.metadata_cache.get("points", self._compress_grids)
+            )
+        self._prepare_zones()
+        self.output.select()
+        self.output.add_aggregation(self.time)
+        self._add_outputs()
+        self.meteo.open(self.time, self.gridspec["L1"], self.masks["L1"])
+        for var in self.INPUT_NAMES:
+            # grid and units are checked and converted by the component
+            self.inputs.add(
+                name=var,
+                time=self.time,
+                grid=None,
+                missing_value=self.no_data,
+                _FillValue=self.no_data,
+                mask=None,
+                units=None,
+            )
+        self.output.open_writer(
+            self.time,
+            self.gridspec,
+            {name: self.outputs[name].info.meta for name in self.output.data},
         )
-        self.masks["L1"] = mhm.get_mask("L1")
-        if self.mrm_active:
-            # get grid info l11 (swap rows/cols to get "ij" indexing)
-            nrows, ncols, __, xll, yll, cell_size, no_data = mhm.get.l11_domain_info()
-            self.gridspec["L11"] = fm.EsriGrid(
+        self.create_connector()
+        self.metadata_cache.save()
+        self.profiler.add("initialize", start)
+
+    def _read_grids(self):
+        """Read the no-data value, grid specifications and masks of mHM."""
+        gridspec, masks = {}, {}
+        levels = ["L0", "L1", "L11", "L2"] if self.mrm_active else ["L0", "L1", "L2"]
+        infos = {
+            level: getattr(mhm.get, f"{level.lower()}_domain_info")()
+            for level in levels
+        }
+        for level, info in infos.items():
+            # get grid info (swap rows/cols to get "ij" indexing)
+            nrows, ncols, __, xll, yll, cell_size, __ = info
+            gridspec[level] = fm.EsriGrid(
                 ncols=ncols,
                 nrows=nrows,
                 cellsize=cell_size,
                 xllcorner=xll,
                 yllcorner=yll,
             )
-            self.masks["L11"] = mhm.get_mask("L11")
-        # get grid info l2 (swap rows/cols to get "ij" indexing)
-        nrows, ncols, __, xll, yll, cell_size, no_data = mhm.get.l2_domain_info()
-        self.gridspec["L2"] = fm.EsriGrid(
-            ncols=ncols, nrows=nrows, cellsize=cell_size, xllcorner=xll, yllcorner=yll
-        )
-        self.masks["L2"] = mhm.get_mask("L2")
-        for var, meta in OUTPUT_META.items():
-            grid_name = _get_grid_name(var)
-            self.outputs.add(
-                name=var,
-                time=self.time,
-                grid=self.gridspec[grid_name],
-                missing_value=self.no_data,
-                _FillValue=self.no_data,
-                mask=self.masks[grid_name],
-                **meta,
-            )
+            masks[level] = mhm.get_mask(level)
+        return infos["L0"][-1], gridspec, masks
+
+    def _compress_grids(self):
+        """Unstructured points at the active cells of all grids."""
+        return {
+            grid_name: _get_points(self.gridspec[grid_name], mask)
+            for grid_name, mask in self.masks.items()
+        }
+
+    def _output_metas(self):
+        """Meta data of all outputs by name."""
+        metas = dict(OUTPUT_META)
         if self.mrm_active:
-            for var, meta in MRM_OUTPUT_META.items():
-                grid_name = _get_grid_name(var)
-                self.outputs.add(
-                    name=var,
-                    time=self.time,
-                    grid=self.gridspec[grid_name],
-                    missing_value=self.no_data,
-                    _FillValue=self.no_data,
-                    mask=self.masks[grid_name],
-                    **meta,
-                )
-        for var, meta in OUTPUT_CALC_META.items():
-            grid_name = _get_grid_name(var)
-            self.outputs.add(
-                name=var,
-                time=self.time,
-                grid=self.gridspec[grid_name],
-                missing_value=self.no_data,
-                _FillValue=self.no_data,
-                mask=self.masks[grid_name],
-                **meta,
-            )
-        for var, meta in OUTPUT_HORIZONS_META.items():
-            grid_name = _get_grid_name(var)
+            metas.update(MRM_OUTPUT_META)
+        metas.update(OUTPUT_CALC_META)
+        for var, meta in {**OUTPUT_HORIZONS_META, **OUTPUT_CALC_HORIZONS_META}.items():
             for horizon in self.horizons:
                 # add horizon number to long name
-                n_meta = {
+                metas[_horizon_name(var, horizon)] = {
                     att: val.format(n=horizon) if att == "long_name" else val
                     for att, val in meta.items()
                 }
-                self.outputs.add(
-                    name=_horizon_name(var, horizon),
-                    time=self.time,
-                    grid=self.gridspec[grid_name],
-                    missing_value=self.no_data,
-                    _FillValue=self.no_data,
-                    mask=self.masks[grid_name],
-                    **n_meta,
+        for zone, names in self.output.zone_outputs.items():
+            for var in names:
+                meta = dict(metas[var])
+                if zone == _GAUGES:
+                    meta["long_name"] += " at evaluation gauges"
+                else:
+                    meta["long_name"] += f" (mean over {zone})"
+                    meta["cell_methods"] = "area: mean"
+                metas[_zone_name(var, zone)] = meta
+        return metas
+
+    def _add_outputs(self):
+        """Add all selected outputs with their meta data."""
+        for name, meta in self._output_metas().items():
+            if name in self.output.data:
+                self._add_output(name, **meta)
+
+    def _prepare_zones(self):
+        """Create the zone indices and data functions of all zone outputs."""
+        zones = dict(self.output.options.zones)
+        if self.mrm_active:
+            # zone of the evaluation gauges defined by their L11 cells
+            gauge_ids, cells = self.metadata_cache.get("gauges", self._find_gauges)
+            if cells:
+                self.output.gauge_ids = gauge_ids
+                zones[_GAUGES] = (cells, ["L11_QMOD"])
+        for zone, (definition, names) in zones.items():
+            mask = self.masks[_get_grid_name(names[0])]
+            grid_name, zone_mask = self.output.add_zone(zone, definition, names, mask)
+            self.masks[grid_name] = zone_mask
+
+    def _find_gauges(self):
+        """IDs of the evaluation gauges and their L11 cells."""
+        gauges = self.config.get("evaluation_gauges", {})
+        morph = self.config.get("directories_general", {}).get("dir_morpho")
+        path = self.cwd / (_first(morph) or ".") / "idgauges.asc"
+        if not gauges or not path.exists():
+            return [], []
+        ids = _read_asc(path)
+        if ids.shape != self.masks["L0"].shape:
+            msg = f"mHM: gauge locations need shape {self.masks['L0'].shape}"
+            raise ValueError(msg)
+        gauge_ids = [g for g in np.ravel(gauges.get("gauge_id", [])) if g is not None]
+        grid = self.gridspec["L0"]
+        found, cells = [], []
+        for gauge_id in gauge_ids:
+            flat = np.ravel_multi_index(
+                np.nonzero(ids == gauge_id), grid.data_shape, order=grid.order
+            )
+            if len(flat) == 0:
+                msg = f"mHM: location of gauge {gauge_id} not found."
+                raise ValueError(msg)
+            points = grid.cell_centers[flat[:1]]
+            cell = _find_cells(self.gridspec["L11"], points)
+            if self.masks["L11"].ravel()[cell[0]]:
+                # zones need active cells
+                self.logger.warning(
+                    "gauge %s skipped, it is not on an active L11 cell", gauge_id
                 )
-        for var, meta in OUTPUT_CALC_HORIZONS_META.items():
-            grid_name = _get_grid_name(var)
-            for horizon in self.horizons:
-                # add horizon number to long name
-                n_meta = {
-                    att: val.format(n=horizon) if att == "long_name" else val
-                    for att, val in meta.items()
-                }
-                self.outputs.add(
-                    name=_horizon_name(var, horizon),
-                    time=self.time,
-                    grid=self.gridspec[grid_name],
-                    missing_value=self.no_data,
-                    _FillValue=self.no_data,
-                    mask=self.masks[grid_name],
-                    **n_meta,
+                continue
+            found.append(int(gauge_id))
+            cells.append(cell)
+        return found, cells
+
+    def _add_output(self, name, **meta):
+        """Add an output on its grid with the given meta data."""
+        grid_name = _get_grid_name(name)
+        dtype = self.output.dtype(name)
+        if dtype != float:
+            meta["dtype"] = dtype.name
+        if name in self.output.aggregation:
+            method = self.output.aggregation[name].method
+            methods = [meta.get("cell_methods"), f"time: {AGGREGATION_METHODS[method]}"]
+            meta["cell_methods"] = " ".join(m for m in methods if m)
+            if method == "sum":
+                # sum of hourly values
+                meta["units"] = f"{meta['units']} * h"
+        if _is_zone(grid_name):
+            grid, mask = fm.NoGrid(1), fm.Mask.NONE
+        elif self.output.options.compressed:
+            grid, mask = self.output.points[grid_name], fm.Mask.NONE
+        else:
+            grid, mask = self.gridspec[grid_name], self.masks[grid_name]
+        self.outputs.add(
+            name=name,
+            time=self.time,
+            grid=grid,
+            missing_value=self.no_data,
+            _FillValue=self.no_data,
+            mask=mask,
+            **meta,
+        )
+
+    def _do_time_step(self):
+        """Run a single hourly mHM time-step."""
+        # set meteo data every hour or every 24 hours
+        if self.meteo.names and self.time.hour % self.meteo.timestep == 0:
+            with self.profiler.timer("pull_meteo"):
+                if self.meteo.prefetch is not None:
+                    kwargs = self.meteo.prefetch.get(self.time)
+                else:
+                    kwargs = self._pull_meteo(self.time)
+            with self.profiler.timer("set_meteo"):
+                mhm.set_meteo(time=self.time, **kwargs)
+        # run mhm
+        with self.profiler.timer("do_time_step"):
+            mhm.run.do_time_step()
+        self.output.cache.clear()
+        # update time
+        year, month, day, hour = mhm.run.current_time()
+        self.time = datetime(year=year, month=month, day=day, hour=hour)
+        # aggregate outputs in every mHM time-step
+        self.output.aggregate(self._is_used)
+
+    def _pull_meteo(self, time):
+        """Pull meteo data for the mHM time-step starting at the given time."""
+        return {
+            var: (
+                self.meteo.readers[name].read(time)
+                if name in self.meteo.readers
+                else self._convert_meteo(
+                    name, self.inputs[name].pull_data(time + _MHM_STEP)[0]
                 )
-        for var in self.INPUT_NAMES:
-            grid_name = _get_grid_name(var)
-            self.inputs.add(
-                name=var,
-                time=self.time,
-                grid=None if self.ignore_input_grid else self.gridspec[grid_name],
-                missing_value=self.no_data,
-                _FillValue=self.no_data,
-                mask=None if self.ignore_input_grid else self.masks[grid_name],
-                units=INPUT_UNITS[var].format(
-                    ts=HOURS_TO_TIMESTEP[self.meteo_timestep]
-                ),
             )
-        self.create_connector()
+            for var, name in self.meteo.names.items()
+        }
+
+    def _convert_meteo(self, name, data):
+        """Convert pulled meteo data to the units and grid of mHM."""
+        return self.meteo.convert(name, self.inputs[name].info, data.magnitude)
+
+    def _has_targets(self, name):
+        """Whether an output has targets."""
+        return self.outputs[name].has_targets
+
+    def _is_used(self, name):
+        """Whether an output has targets or is written to the output file."""
+        return self._has_targets(name) or name in self.output.written
+
+    def _push_output(self, name, values):
+        """Push compressed values to an output."""
+        with self.profiler.timer("push:" + name):
+            data = self.output.fill(values, name, self.outputs[name])
+            self.outputs[name].push_data(data=data, time=self.time)
+
+    def profile_stats(self):
+        """
+        Profile statistics of the component.
+
+        Returns
+        -------
+        dict
+            Number of calls ("count"), cumulative time ("time") and
+            mean time ("mean") in seconds for each phase of the component.
+            Empty if profiling is not active.
+        """
+        return self.profiler.summary()
 
     def _connect(self, start_time):
-        push_data = {var: mhm.get_variable(var) for var in OUTPUT_META}
-        if self.mrm_active:
-            push_data.update({var: mhm.get_variable(var) for var in MRM_OUTPUT_META})
-        push_data.update({var: func() for var, func in OUTPUT_CALC.items()})
-        push_data.update(
-            {
-                _horizon_name(var, horizon): mhm.get_variable(var, index=horizon)
-                for var in OUTPUT_HORIZONS_META
-                for horizon in self.horizons
-            }
-        )
-        push_data.update(
-            {
-                _horizon_name(var, horizon): func(horizon)
-                for var, func in OUTPUT_CALC_HORIZON.items()
-                for horizon in self.horizons
-            }
-        )
+        start = perf_counter()
+        # only calculate initial data for connected outputs that still need it
+        # (pushing to outputs without targets does nothing)
+        push_data = {
+            name: self.output.fill(self.output.data[name](), name)
+            if self.outputs[name].has_targets
+            else None
+            for name, required in self.connector.data_required.items()
+            if required
+        }
         self.try_connect(start_time=start_time, push_data=push_data)
+        self.meteo.connect(self.inputs)
+        self.profiler.add("connect", start)
 
-    @fm.tools.execute_in_cwd
     def _update(self):
         # Don't run further than mHM can
         if mhm.run.finished():
             return
-        # set meteo data
-        if self.meteo_inputs:
-            # every hour or every 24 hours
-            if self.time.hour % self.meteo_timestep == 0:
-                kwargs = {
-                    var: self.inputs[name].pull_data(self.next_time)[0].magnitude
-                    for var, name in self.meteo_inputs.items()
-                }
-                kwargs["time"] = self.time
-                mhm.set_meteo(**kwargs)
-        # run mhm
-        mhm.run.do_time_step()
-        # update time
-        year, month, day, hour = mhm.run.current_time()
-        self.time = datetime(year=year, month=month, day=day, hour=hour)
+        start = perf_counter()
+        # run mhm until the next coupling time
+        next_time = self.next_time
+        if self.meteo.names:
+            self.meteo.start_prefetch(self._pull_meteo, self.time, next_time)
+        try:
+            while self.time < next_time and not mhm.run.finished():
+                self._do_time_step()
+        finally:
+            self.meteo.stop_prefetch()
+        finished = mhm.run.finished()
         # push outputs
-        for var in OUTPUT_META:
-            if not self.outputs[var].has_targets:
+        file_data = {}
+        for name in self.output.data:
+            if not self._is_used(name):
                 continue
-            self.outputs[var].push_data(
-                data=mhm.get_variable(var),
-                time=self.time,
-            )
-        if self.mrm_active:
-            for var in MRM_OUTPUT_META:
-                if not self.outputs[var].has_targets:
-                    continue
-                self.outputs[var].push_data(
-                    data=mhm.get_variable(var),
-                    time=self.time,
-                )
-        for var, func in OUTPUT_CALC.items():
-            if not self.outputs[var].has_targets:
+            data = self.output.get(name, self.time, finished)
+            if data is None:
                 continue
-            self.outputs[var].push_data(
-                data=func(),
-                time=self.time,
-            )
-        for var in OUTPUT_HORIZONS_META:
-            for horizon in self.horizons:
-                name = _horizon_name(var, horizon)
-                if not self.outputs[name].has_targets:
-                    continue
-                self.outputs[name].push_data(
-                    data=mhm.get_variable(var, index=horizon),
-                    time=self.time,
-                )
-        for var, func in OUTPUT_CALC_HORIZON.items():
-            for horizon in self.horizons:
-                name = _horizon_name(var, horizon)
-                if not self.outputs[name].has_targets:
-                    continue
-                self.outputs[name].push_data(
-                    data=func(horizon),
-                    time=self.time,
-                )
-        if mhm.run.finished():
+            if self._has_targets(name):
+                self._push_output(name, data)
+            if name in self.output.written:
+                file_data[name] = data
+        if file_data:
+            with self.profiler.timer("write"):
+                self.output.writer.put(self.time, file_data)
+        if finished:
             self.status = fm.ComponentStatus.FINISHED
+        self.profiler.add("update", start)
+        if self.profiler.interval:
+            if self.profiler.stats["update"][0] % self.profiler.interval == 0:
+                self.logger.info("profile: %s", self.profile_stats())
 
-    @fm.tools.execute_in_cwd
     def _finalize(self):
+        # mHM writes the restart files when finalizing the domain
         mhm.run.finalize_domain()
+        if self.restart.write is not None:
+            time_file = self.restart.write / _STATE_FILES["time"]
+            if self.time.hour == 0:
+                time_file.write_text(self.time.isoformat(), encoding="utf-8")
+            else:
+                # mHM can only restart at midnight, so the state is not usable
+                time_file.unlink(missing_ok=True)
+                self.logger.warning(
+                    "state at %s not saved, states can only be saved at midnight",
+                    self.time,
+                )
         mhm.run.finalize()
         mhm.model.finalize()
+        self.meteo.close()
+        self.output.close()
+        if self.profiler.path is not None:
+            self.profiler.write()
@@ -42,7 +42,6 @@ Constants
 """
 
 # pylint: disable=R1735
-import mhm
 import numpy as np
 
 OUTPUT_META = {
@@ -170,81 +169,66 @@ INPUT_UNITS = {
 HOURS_TO_TIMESTEP = {1: "h", 24: "d"}
 """timestep string from hours."""
 
+AGGREGATION_METHODS = {"sum": "sum", "mean": "mean", "max": "maximum", "min": "minimum"}
+"""available temporal aggregation methods and their CF cell method."""
 
-def _fill_var(var, grid="l1"):
-    grid_info = getattr(mhm.get, grid + "_domain_info")()
-    # mask in mHM is the opposite in numpy (selection)
-    sel = mhm.get_mask(grid, indexing="xy", selection=True)
-    sel = sel.ravel(order="F")
-    output = np.ma.empty_like(sel, dtype=float)
-    output.fill_value = grid_info[-1]
-    output.mask = ~sel
-    output[sel] = var
-    return output.reshape((grid_info[0], grid_info[1]), order="C")
 
+def _L1_AET(cache):
+    # sum(aETSoil(horizons) * fNotSealed) + aETCanopy + aETSealed * fSealed
+    fsealed = cache.get("L1_FSEALED")
+    aetcanopy = cache.get("L1_AETCANOPY")
+    aetsealed = cache.get("L1_AETSEALED")
+    aetsoil = cache.calc(_L1_AET_N)
+    return aetsoil.sum(axis=1) + aetcanopy + aetsealed * fsealed
 
-def _L1_AET():
-    # sum(aETSoil(horizons)) * fNotSealed + aETCanopy + aETSealed * fSealed
-    fsealed = mhm.get_variable("L1_FSEALED", compressed=True)
-    fnotsealed = mhm.get_variable("L1_FNOTSEALED", compressed=True)
-    aetcanopy = mhm.get_variable("L1_AETCANOPY", compressed=True)
-    aetsealed = mhm.get_variable("L1_AETSEALED", compressed=True)
-    horizons = mhm.get.number_of_horizons()
-
-    sum_aetsoil = np.zeros_like(fsealed, dtype=float)
-    for n in range(1, horizons + 1):
-        sum_aetsoil += mhm.get_variable("L1_AETSOIL", index=n, compressed=True)
-
-    return _fill_var(sum_aetsoil * fnotsealed + aetcanopy + aetsealed * fsealed)
 
-
-def _L1_QD():
+def _L1_QD(cache):
     # runoffSeal * fSealed
-    fsealed = mhm.get_variable("L1_FSEALED", compressed=True)
-    runoffseal = mhm.get_variable("L1_RUNOFFSEAL", compressed=True)
-    return _fill_var(runoffseal * fsealed)
+    fsealed = cache.get("L1_FSEALED")
+    runoffseal = cache.get("L1_RUNOFFSEAL")
+    return runoffseal * fsealed
 
 
-def _L1_QIF():
+def _L1_QIF(cache):
     # fastRunoff * fNotSealed
-    fnotsealed = mhm.get_variable("L1_FNOTSEALED", compressed=True)
-    fastrunoff = mhm.get_variable("L1_FASTRUNOFF", compressed=True)
-    return _fill_var(fastrunoff * fnotsealed)
+    fnotsealed = cache.get("L1_FNOTSEALED")
+    fastrunoff = cache.get("L1_FASTRUNOFF")
+    return fastrunoff * fnotsealed
 
 
-def _L1_QIS():
+def _L1_QIS(cache):
     # slowRunoff * fNotSealed
-    fnotsealed = mhm.get_variable("L1_FNOTSEALED", compressed=True)
-    slowrunoff = mhm.get_variable("L1_SLOWRUNOFF", compressed=True)
-    return _fill_var(slowrunoff * fnotsealed)
+    fnotsealed = cache.get("L1_FNOTSEALED")
+    slowrunoff = cache.get("L1_SLOWRUNOFF")
+    return slowrunoff * fnotsealed
 
 
-def _L1_QB():
+def _L1_QB(cache):
     # baseflow * fNotSealed
-    fnotsealed = mhm.get_variable("L1_FNOTSEALED", compressed=True)
-    baseflow = mhm.get_variable("L1_BASEFLOW", compressed=True)
-    return _fill_var(baseflow * fnotsealed)
+    fnotsealed = cache.get("L1_FNOTSEALED")
+    baseflow = cache.get("L1_BASEFLOW")
+    return baseflow * fnotsealed
 
 
-def _L1_RECHARGE():
+def _L1_RECHARGE(cache):
     # percol * fNotSealed
-    fnotsealed = mhm.get_variable("L1_FNOTSEALED", compressed=True)
-    percol = mhm.get_variable("L1_PERCOL", compressed=True)
-    return _fill_var(percol * fnotsealed)
+    fnotsealed = cache.get("L1_FNOTSEALED")
+    percol = cache.get("L1_PERCOL")
+    return percol * fnotsealed
 
 
-def _L1_SOIL_INFIL_N(n):
-    # infilSoil(horizon) * fNotSealed
-    fnotsealed = mhm.get_variable("L1_FNOTSEALED", compressed=True)
-    infilsoil = mhm.get_variable("L1_INFILSOIL", index=n, compressed=True)
-    return _fill_var(infilsoil * fnotsealed)
+def _L1_SOIL_INFIL_N(cache):
+    # infilSoil(horizons) * fNotSealed
+    fnotsealed = cache.get("L1_FNOTSEALED")
+    infilsoil = cache.get_horizons("L1_INFILSOIL")
+    return infilsoil * fnotsealed[:, np.newaxis]
 
 
-def _L1_AET_N(n):
-    # aETSoil(horizon) * fNotSealed
-    fnotsealed = mhm.get_variable("L1_FNOTSEALED", compressed=True)
-    aetsoil = mhm.get_variable("L1_AETSOIL", index=n, compressed=True)
-    return _fill_var(aetsoil * fnotsealed)
+def _L1_AET_N(cache):
+    # aETSoil(horizons) * fNotSealed
+    fnotsealed = cache.get("L1_FNOTSEALED")
+    aetsoil = cache.get_horizons("L1_AETSOIL")
+    return aetsoil * fnotsealed[:, np.newaxis]
 
 
 OUTPUT_CALC = {
@@ -0,0 +1,181 @@
+"""
+Ensembles of mHM runs in separate processes.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context, shared_memory
+
+import mhm
+import numpy as np
+
+from .component import MHM
+from .constants import (
+    MRM_OUTPUT_META,
+    OUTPUT_CALC_HORIZONS_META,
+    OUTPUT_CALC_META,
+    OUTPUT_HORIZONS_META,
+    OUTPUT_META,
+)
+from .options import _GAUGES, OutputOptions
+from .output import _ZONE, _get_grid_name
+
+
+def _check_outputs(outputs, options):
+    """
+    Check the names of the outputs to collect before initializing mHM.
+
+    The number of horizons, whether mRM is active and the selected output
+    names are only known after initializing and are checked by the members.
+
+    Raises
+    ------
+    ValueError
+        If an output is not available.
+    """
+    zones = {_GAUGES: ["L11_QMOD"]}
+    zones.update({zone: names for zone, (__, names) in options.zones.items()})
+    for name in outputs:
+        var, __, zone = name.partition(_ZONE)
+        base, __, horizon = var.rpartition("_L")
+        if zone:
+            known = zone in zones and var in zones[zone]
+        elif horizon.isdigit():
+            known = base in OUTPUT_HORIZONS_META or base in OUTPUT_CALC_HORIZONS_META
+        else:
+            known = var in OUTPUT_META or var in MRM_OUTPUT_META
+            known = known or var in OUTPUT_CALC_META
+        if not known:
+            msg = f"mHM: output '{name}' is not available."
+            raise ValueError(msg)
+
+
+def _run_member(kwargs, outputs, end_time):
+    """Run an ensemble member and put the collected outputs in shared memory."""
+    model = MHM(**kwargs)
+    # fail before running mHM for outputs that can't exist
+    _check_outputs(outputs, model.output.options)
+    model.initialize()
+    memory, data, times = {}, {}, []
+    try:
+        for name in outputs:
+            if name not in model.output_data:
+                msg = f"mHM: output '{name}' is not available."
+                raise ValueError(msg)
+        steps = (end_time - model.time) // model.step + 1
+        for name in outputs:
+            size = len(model.output.scatter[_get_grid_name(name)][0])
+            memory[name] = shared_memory.SharedMemory(
+                create=True, size=max(steps * size * 8, 1)
+            )
+            data[name] = np.ndarray((steps, size), dtype=float, buffer=memory[name].buf)
+        while True:
+            for name, values in data.items():
+                values[len(times)] = model.output_data[name]()
+            times.append(model.time)
+            if len(times) == steps or mhm.run.finished():
+                break
+            model.update()
+    except BaseException:
+        # blocks are only released by the collecting process on success
+        data.clear()
+        for shm in memory.values():
+            shm.close()
+            shm.unlink()
+        raise
+    finally:
+        # worker processes are reused for the following members
+        model.finalize()
+    # views need to be released before closing the shared memory
+    data.clear()
+    shared = {}
+    for name, shm in memory.items():
+        grid_name = _get_grid_name(name)
+        shape = (steps, len(model.output.scatter[grid_name][0]))
+        shared[name] = (shm.name, shape, model.masks[grid_name], model.no_data)
+        shm.close()
+    return times, shared
+
+
+def _collect(times, shared):
+    """Collect the outputs of an ensemble member from shared memory."""
+    result = {"time": times}
+    for name, (shm_name, shape, mask, no_data) in shared.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        try:
+            data = np.ndarray(shape, dtype=float, buffer=shm.buf)[: len(times)]
+            output = np.full((len(times), mask.size), no_data, dtype=float)
+            output[:, np.flatnonzero(~mask)] = data
+            del data
+        finally:
+            shm.close()
+            shm.unlink()
+        result[name] = np.ma.array(
+            output.reshape((len(times),) + mask.shape),
+            mask=np.broadcast_to(mask, (len(times),) + mask.shape),
+            fill_value=no_data,
+        )
+    return result
+
+
+class MHMEnsemble:
+    """
+    Ensemble of mHM runs with each member running in its own process.
+
+    Only one mHM instance can run per process. The ensemble runs all members
+    in a pool of worker processes and returns the collected outputs
+    through shared memory. Scripts using the ensemble need to guard the
+    main code with ``if __name__ == "__main__":``.
+
+    Parameters
+    ----------
+    members : list of dict
+        Keyword arguments for :class:`MHM` for each ensemble member,
+        e.g. differing in ``cwd`` or ``namelist_mhm_param``.
+        Members can't have coupled inputs.
+    outputs : list of str
+        Names of the outputs to collect for all members.
+    max_workers : int, optional
+        Maximal number of worker processes, by default the number of CPUs
+
+    Raises
+    ------
+    ValueError
+        If a member has coupled inputs.
+    ValueError
+        If an output is not available for a member.
+    """
+
+    def __init__(self, members, outputs, max_workers=None):
+        self.members = [dict(member) for member in members]
+        self.outputs = list(outputs)
+        self.max_workers = max_workers
+        for member in self.members:
+            if member.get("input_names"):
+                msg = "mHM ensemble: members can't have coupled inputs."
+                raise ValueError(msg)
+            _check_outputs(self.outputs, member.get("output") or OutputOptions())
+
+    def run(self, end_time):
+        """
+        Run all ensemble members.
+
+        Parameters
+        ----------
+        end_time : datetime.datetime
+            Time to run the members to.
+
+        Returns
+        -------
+        list of dict
+            Results for each member holding the output times under "time"
+            and the collected outputs as masked arrays with the time
+            as first dimension under their names.
+        """
+        # mHM can't be safely forked after it was used in this process
+        context = get_context("spawn")
+        with ProcessPoolExecutor(self.max_workers, mp_context=context) as pool:
+            futures = [
+                pool.submit(_run_member, member, self.outputs, end_time)
+                for member in self.members
+            ]
+            return [_collect(*future.result()) for future in futures]
@@ -0,0 +1,506 @@
+"""
+Meteo input handling of the mHM component.
+"""
+
+import hashlib
+from datetime import timedelta
+from pathlib import Path
+from queue import Queue
+from threading import Lock, Thread
+
+import finam as fm
+import numpy as np
+
+from .constants import HOURS_TO_TIMESTEP, INPUT_UNITS
+from .tools import _MHM_STEP
+
+# NetCDF/HDF5 is not thread-safe, so all file access is serialized
+_NETCDF_LOCK = Lock()
+
+
+def _get_var_name(var):
+    return "_".join(var.split("_")[1:])
+
+
+def _get_meteo_inputs(inputs):
+    return {
+        _get_var_name(var).lower(): var for var in inputs if var.startswith("METEO")
+    }
+
+
+def _source_mask(info, data=None):
+    """
+    Mask of meteo input data, resolved from the data for flexible masks.
+
+    Returns None for flexible masks without data.
+    """
+    if isinstance(info.mask, np.ndarray):
+        return np.asarray(info.mask, dtype=bool)
+    if info.mask == fm.Mask.NONE:
+        return np.ma.nomask
+    return None if data is None else np.ma.getmaskarray(data)
+
+
+def _cell_bounds(axis, cells):
+    """Lower and upper bounds of the cells along a grid axis."""
+    axis = np.asarray(axis, dtype=float)
+    if not cells:
+        if len(axis) < 2:
+            msg = "mHM: can't remap meteo input with a single point along an axis."
+            raise ValueError(msg)
+        # data at points is representative for the cells between the midpoints
+        mid = (axis[1:] + axis[:-1]) / 2
+        axis = np.concatenate([[2 * axis[0] - mid[0]], mid, [2 * axis[-1] - mid[-1]]])
+    return np.minimum(axis[:-1], axis[1:]), np.maximum(axis[:-1], axis[1:])
+
+
+def _axis_bounds(grid):
+    """Cell bounds of a rectilinear grid along each axis in the order of its data."""
+    cells = grid.data_location == fm.Location.CELLS
+    bounds = []
+    for axis, increase in zip(grid.axes, grid.axes_increase):
+        lower, upper = _cell_bounds(axis, cells)
+        # data of decreasing axes is stored in reversed order
+        bounds.append((lower, upper) if increase else (lower[::-1], upper[::-1]))
+    return bounds
+
+
+def _flat_cells(grid, cells):
+    """Flat ("C" order) data indices of cells given by their index along each axis."""
+    cells = cells[::-1] if grid.axes_reversed else cells
+    return np.ravel_multi_index(tuple(cells), grid.data_shape)
+
+
+def _overlaps(source, target):
+    """Overlap lengths of target (rows) and source (columns) cells along an axis."""
+    (s_lo, s_hi), (t_lo, t_hi) = source, target
+    overlap = np.minimum(t_hi[:, None], s_hi) - np.maximum(t_lo[:, None], s_lo)
+    return np.maximum(overlap, 0.0)
+
+
+def _overlap_weights(source, target, s_bounds, t_bounds):
+    """Flat target cells, flat source cells and overlap areas of overlapping cells."""
+    # sparse outer product of the cell overlaps along all axes
+    overlaps = [_overlaps(s_ax, t_ax) for s_ax, t_ax in zip(s_bounds, t_bounds)]
+    entries = [np.nonzero(overlap) for overlap in overlaps]
+    pos = np.meshgrid(*[np.arange(len(t)) for t, _ in entries], indexing="ij")
+    t_cells = [t[p.ravel()] for (t, _), p in zip(entries, pos)]
+    s_cells = [s[p.ravel()] for (_, s), p in zip(entries, pos)]
+    weights = np.prod([o[t, s] for o, t, s in zip(overlaps, t_cells, s_cells)], axis=0)
+    return _flat_cells(target, t_cells), _flat_cells(source, s_cells), weights
+
+
+def _grid_hash(*arrays):
+    """Hash of the given arrays to identify remapping weights."""
+    sha = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        sha.update(str((array.dtype, array.shape)).encode())
+        sha.update(array.tobytes())
+    return sha.hexdigest()
+
+
+class _Regridding:
+    """
+    Area-weighted remapping from a rectilinear grid to the active cells of L1.
+
+    The weights are stored as a sparse matrix in coordinate format,
+    so that remapping data is a single sparse matrix-vector product.
+    Inactive cells of the target are masked.
+    """
+
+    def __init__(self, rows, cols, weights, mask):
+        self.rows = rows
+        self.cols = cols
+        self.weights = weights
+        self.mask = mask
+
+    @classmethod
+    def from_grids(cls, source, target, mask, source_mask=None, cache=None):
+        """
+        Create the remapping from the source grid to the target grid.
+
+        Cells of the source that are masked by the resolved ``source_mask``
+        are ignored and the weights of each target cell are normalized by the
+        overlapping area. The weights are read from and written to ``cache``
+        if it is given.
+
+        Raises
+        ------
+        ValueError
+            If the source grid is not rectilinear or doesn't cover the target
+            with unmasked cells.
+        """
+        if not isinstance(source, fm.RectilinearGrid) or source.dim != target.dim:
+            msg = f"mHM: can't remap meteo input from {type(source).__name__} to L1."
+            raise ValueError(msg)
+        if source.crs is not None and target.crs is not None:
+            if source.crs != target.crs:
+                msg = "mHM: can't remap meteo input with a different CRS to L1."
+                raise ValueError(msg)
+        if source_mask is None or source_mask is np.ma.nomask:
+            source_mask = np.zeros(source.data_shape, dtype=bool)
+        s_bounds, t_bounds = _axis_bounds(source), _axis_bounds(target)
+        path = None
+        if cache is not None:
+            key = _grid_hash(
+                *[b for bounds in s_bounds + t_bounds for b in bounds],
+                [source.axes_reversed, target.axes_reversed],
+                source_mask,
+                mask,
+            )
+            path = Path(cache) / f"regrid_{key}.npz"
+            if path.exists():
+                with np.load(path) as data:
+                    return cls(data["rows"], data["cols"], data["weights"], mask)
+        rows, cols, weights = _overlap_weights(source, target, s_bounds, t_bounds)
+        valid = ~np.ravel(mask)[rows] & ~np.ravel(source_mask)[cols]
+        rows, cols, weights = rows[valid], cols[valid], weights[valid]
+        area = np.bincount(rows, weights=weights, minlength=mask.size)
+        if np.any(area[~np.ravel(mask)] <= 0):
+            msg = (
+                "mHM: grid of meteo input doesn't cover the active cells of L1 "
+                "with unmasked cells."
+            )
+            raise ValueError(msg)
+        weights = weights / area[rows]
+        if path is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            np.savez(path, rows=rows, cols=cols, weights=weights)
+        return cls(rows, cols, weights, mask)
+
+    def __call__(self, data):
+        """Remap the data of a single time-step."""
+        values = np.ma.getdata(data).reshape(-1)[self.cols]
+        values = np.bincount(
+            self.rows, weights=self.weights * values, minlength=self.mask.size
+        )
+        return np.ma.array(values.reshape(self.mask.shape), mask=self.mask)
+
+
+class _MeteoConversion:
+    """
+    Conversion of pulled meteo data to the units and grid of mHM.
+
+    The unit conversion is resolved once into a linear transformation
+    and the transformation of compatible grids into a cell index,
+    so that converting data is a cheap vectorized operation.
+    Incompatible rectilinear grids can be remapped to L1 with
+    precomputed area weights, see :class:`_Regridding`.
+    The resolved mask of the data (``source_mask``) must not mask
+    active cells of L1, since mHM needs values there.
+
+    Raises
+    ------
+    ValueError
+        If units or grids are not compatible.
+    ValueError
+        If the data is masked at active cells of L1.
+    """
+
+    def __init__(
+        self,
+        info,
+        units,
+        grid=None,
+        mask=None,
+        regrid=False,
+        cache=None,
+        source_mask=None,
+    ):
+        try:
+            values = fm.UNITS.Quantity(np.array([0.0, 1.0]), info.units).to(units)
+        except Exception as err:
+            msg = f"mHM: can't convert meteo input from '{info.units}' to '{units}'"
+            raise ValueError(msg) from err
+        self.offset = float(values.magnitude[0])
+        self.factor = float(values.magnitude[1] - values.magnitude[0])
+        self.index = None
+        self.regridding = None
+        if grid is not None:
+            if info.grid.compatible_with(grid):
+                transform = info.grid.get_transform_to(grid)
+                if transform is not None:
+                    cells = np.arange(np.prod(info.grid.data_shape))
+                    self.index = transform(cells.reshape(info.grid.data_shape))
+            elif regrid:
+                self.regridding = _Regridding.from_grids(
+                    info.grid, grid, mask, source_mask, cache
+                )
+            else:
+                msg = "mHM: grid of meteo input is not compatible with L1."
+                raise ValueError(msg)
+        # masked cells of remapped grids are already excluded by the weights
+        if self.regridding is None and mask is not None and np.any(source_mask):
+            masked = source_mask
+            if self.index is not None:
+                masked = source_mask.reshape(-1)[self.index]
+            if masked.shape == mask.shape and np.any(masked & np.logical_not(mask)):
+                msg = "mHM: meteo input is masked at active cells of L1."
+                raise ValueError(msg)
+
+    def __call__(self, data):
+        """Convert the data of a single time-step."""
+        if self.index is not None:
+            data = data.reshape(-1)[self.index]
+        elif self.regridding is not None:
+            data = self.regridding(data)
+        if self.factor != 1.0 or self.offset != 0.0:
+            data = data * self.factor + self.offset
+        return data
+
+
+class _MeteoPrefetch:
+    """
+    Background thread pulling meteo data ahead of the mHM time-steps.
+
+    At most ``size`` meteo time-steps are pulled ahead into a bounded queue
+    and handed out in order. Errors while pulling are raised by :meth:`get`.
+    """
+
+    def __init__(self, pull, times, size):
+        self.queue = Queue(maxsize=size)
+        self.thread = Thread(target=self._run, args=(pull, times), daemon=True)
+        self.thread.start()
+
+    def _run(self, pull, times):
+        for time in times:
+            try:
+                self.queue.put((time, pull(time)))
+            except Exception as err:  # pylint: disable=W0718
+                self.queue.put((time, err))
+                return
+
+    def get(self, time):
+        """Get the meteo data for the given time."""
+        queued, data = self.queue.get()
+        if isinstance(data, Exception):
+            raise data
+        if queued != time:
+            msg = f"mHM: prefetched meteo data for {queued}, expected {time}"
+            raise RuntimeError(msg)
+        return data
+
+    def close(self):
+        """Wait for the thread after draining the queue."""
+        while self.thread.is_alive() or not self.queue.empty():
+            if self.queue.empty():
+                self.thread.join(timeout=0.01)
+            else:
+                self.queue.get()
+
+
+class _MeteoFile:
+    """
+    Meteo time-slices read directly from a file.
+
+    NumPy ".npy" files are memory-mapped and hold one grid per meteo
+    time-step starting at the given start time. NetCDF files are read
+    slice by slice from the variable with the given name using the times
+    of their "time" coordinate.
+    """
+
+    def __init__(self, path, variable, start, step):
+        self.path = Path(path)
+        self.start = start
+        self.step = step
+        self.file = None
+        self.times = None
+        if self.path.suffix == ".npy":
+            self.data = np.load(self.path, mmap_mode="r")
+            return
+        try:
+            import netCDF4  # pylint: disable=C0415
+        except ImportError as err:
+            msg = f"mHM: reading meteo from '{self.path}' requires netCDF4."
+            raise ImportError(msg) from err
+        with _NETCDF_LOCK:
+            self.file = netCDF4.Dataset(self.path)
+            self.data = self.file[variable]
+            self.data.set_auto_mask(False)
+            time = self.file["time"]
+            times = netCDF4.num2date(
+                time[:],
+                time.units,
+                getattr(time, "calendar", "standard"),
+                only_use_cftime_datetimes=False,
+                only_use_python_datetimes=True,
+            )
+        self.times = np.array(times, dtype="datetime64[s]")
+
+    def read(self, time):
+        """Read the grid of the meteo time-step starting at the given time."""
+        if self.times is None:
+            index = (time - self.start) // self.step
+        else:
+            # first time stamp within the meteo time-step
+            index = np.searchsorted(self.times, np.datetime64(time, "s"))
+            if index < len(self.times) and self.times[index] >= np.datetime64(
+                time + self.step, "s"
+            ):
+                index = len(self.times)
+        if not 0 <= index < len(self.data):
+            msg = f"mHM: no meteo data for {time} in '{self.path}'"
+            raise ValueError(msg)
+        if self.file is None:
+            return np.asarray(self.data[index], dtype=float)
+        with _NETCDF_LOCK:
+            return np.asarray(self.data[index], dtype=float)
+
+    def close(self):
+        """Close the file."""
+        if self.file is not None:
+            with _NETCDF_LOCK:
+                self.file.close()
+
+
+class _MeteoInputs:
+    """
+    Meteo inputs of mHM coupled via FINAM or read directly from files.
+
+    Pulled data is converted to the units and grid of mHM with conversions
+    resolved when connecting, or on the first pull for flexible masks.
+    Files are opened once the start time and the grid of mHM are known.
+
+    Parameters
+    ----------
+    input_names : list of str
+        Names of the inputs coupled via FINAM.
+    timestep : int
+        Meteo time-step in hours.
+    options : MeteoOptions
+        Options for the meteo inputs.
+    ignore_grid : bool, optional
+        Use any input grid without checking compatibility, by default False
+    regrid_cache : str, optional
+        Directory to cache remapping weights in, by default None
+
+    Raises
+    ------
+    ValueError
+        If a meteo input is coupled and read from file.
+    ValueError
+        If the meteo time-step is invalid.
+    """
+
+    def __init__(
+        self, input_names, timestep, options, ignore_grid=False, regrid_cache=None
+    ):
+        for name in options.files:
+            if name in input_names:
+                msg = f"mHM: meteo input '{name}' can't be coupled and read from file."
+                raise ValueError(msg)
+        self.names = _get_meteo_inputs(list(input_names) + list(options.files))
+        self.timestep = timestep
+        self.options = options
+        self.ignore_grid = ignore_grid
+        self.regrid_cache = regrid_cache
+        self.grid = None
+        self.mask = None
+        self.readers = {}
+        self.conversions = {}
+        self.prefetch = None
+        if self.names and self.timestep not in HOURS_TO_TIMESTEP:
+            msg = (
+                "mHM: found meteo inputs but meteo time-step not valid, "
+                f"got {self.timestep}"
+            )
+            raise ValueError(msg)
+
+    @property
+    def coupled(self):
+        """Meteo inputs coupled via FINAM by variable name."""
+        return {
+            var: name for var, name in self.names.items() if name not in self.readers
+        }
+
+    def times(self, start, end):
+        """Start times of the meteo time-steps from start until end."""
+        times = []
+        time = start
+        while time < end:
+            if time.hour % self.timestep == 0:
+                times.append(time)
+            time += _MHM_STEP
+        return times
+
+    def start_prefetch(self, pull, start, end):
+        """Start prefetching the meteo data from start until end."""
+        if self.options.prefetch:
+            times = self.times(start, end)
+            self.prefetch = _MeteoPrefetch(pull, times, self.options.prefetch)
+
+    def stop_prefetch(self):
+        """Stop prefetching meteo data."""
+        if self.prefetch is not None:
+            self.prefetch.close()
+            self.prefetch = None
+
+    def open(self, start, grid, mask):
+        """
+        Open the meteo files and set the grid and mask of L1 for conversions.
+
+        Raises
+        ------
+        ValueError
+            If the grids in a file don't match L1.
+        """
+        self.grid = None if self.ignore_grid else grid
+        self.mask = mask
+        for name, path in self.options.files.items():
+            reader = _MeteoFile(
+                path, _get_var_name(name).lower(), start, timedelta(hours=self.timestep)
+            )
+            self.readers[name] = reader
+            if reader.data.shape[1:] != mask.shape:
+                msg = (
+                    f"mHM: meteo in '{path}' needs grids with shape "
+                    f"{mask.shape}, got {reader.data.shape[1:]}"
+                )
+                raise ValueError(msg)
+
+    def _conversion(self, name, info, source_mask):
+        """Conversion of a meteo input with the given info and data mask."""
+        return _MeteoConversion(
+            info,
+            INPUT_UNITS[name].format(ts=HOURS_TO_TIMESTEP[self.timestep]),
+            self.grid,
+            self.mask,
+            self.options.regrid,
+            self.regrid_cache,
+            source_mask,
+        )
+
+    def connect(self, inputs):
+        """
+        Resolve the conversions of coupled meteo inputs with exchanged infos.
+
+        Conversions of inputs with flexible masks are resolved
+        on the first pull, since their masks are only known from the data.
+
+        Raises
+        ------
+        ValueError
+            If an input can't be converted.
+        """
+        for name in self.coupled.values():
+            info = inputs[name].info
+            if name in self.conversions or info is None:
+                continue
+            source_mask = _source_mask(info)
+            if source_mask is not None:
+                self.conversions[name] = self._conversion(name, info, source_mask)
+
+    def convert(self, name, info, data):
+        """Convert pulled meteo data to the units and grid of mHM."""
+        if name not in self.conversions:
+            # resolved once with the mask of the first pull
+            self.conversions[name] = self._conversion(
+                name, info, _source_mask(info, data)
+            )
+        return self.conversions[name](data)
+
+    def close(self):
+        """Close the meteo files."""
+        for reader in self.readers.values():
+            reader.close()
@@ -0,0 +1,240 @@
+"""
+Options of the mHM component.
+"""
+
+from datetime import timedelta
+
+import numpy as np
+
+from .constants import AGGREGATION_METHODS, INPUT_UNITS
+
+# zone of the evaluation gauges of mRM
+_GAUGES = "GAUGES"
+
+
+class OutputOptions:
+    """
+    Options for the outputs of :class:`MHM`.
+
+    Parameters
+    ----------
+    names : list of str, optional
+        Names of the outputs to provide, given by output names or glob patterns,
+        e.g. ``["L11_QMOD", "L1_SOILMOIST_L*"]``. Other outputs are not created,
+        so the setup and update of the component scale with the used outputs.
+        Zone outputs need to be selected by their own names,
+        where only the zone name is case-sensitive.
+        By default None (all outputs)
+    dtype : str or numpy.dtype or dict, optional
+        Floating point data type of the outputs, either for all outputs or
+        given by output name, e.g. ``"float32"`` to halve memory and bandwidth.
+        Values are cast while filling the output grids and the data type
+        is declared in the meta data of the outputs as ``dtype``.
+        By default None ("float64")
+    compressed : bool, optional
+        Push outputs as 1D arrays of the active cells only, defined on
+        :class:`finam.UnstructuredPoints` at the active cell centers
+        (see :attr:`MHM.compressed_grids`), instead of masked 2D arrays.
+        By default False
+    reuse_buffers : bool, optional
+        Fill the grids of linked outputs into preallocated buffers that are
+        reused once the output released the data pushed with them, instead of
+        allocating new grids for every push. Pushed data are read-only and
+        targets must not keep references to pulled data over time,
+        e.g. time-integrating adapters. Has no effect for compressed outputs.
+        By default False
+    aggregate : dict, optional
+        Outputs to aggregate in time over all hourly mHM time-steps given by
+        output name and a tuple of the aggregation method
+        ("sum", "mean", "max" or "min") and the aggregation interval as
+        :class:`datetime.timedelta`, e.g. ``{"L1_AET": ("mean", timedelta(days=1))}``.
+        The interval needs to be a multiple of the coupling step and
+        aggregated outputs are only pushed at the end of each interval.
+        Sums have units of the hourly values times hours. By default None
+    zones : dict, optional
+        Zones to publish spatial means of outputs for, given by zone name
+        and a tuple of the zone definition and the names of the outputs,
+        e.g. ``{"basins": (basin_ids, ["L1_TOTAL_RUNOFF"])}``.
+        Zones are defined by an integer zone-ID raster array on the grid of the outputs,
+        where cells with negative IDs are not part of a zone,
+        or by a list of arrays with the flat ("ij") or (i, j) cell indices of each zone.
+        The means over the active cells of each zone are pushed as 1D arrays
+        ordered by zone ID to the output ``"<output>_ZONE_<zone name>"``.
+        With mRM active, the zone "GAUGES" is defined by the cells of the
+        evaluation gauges, so that the discharge at the gauges is
+        available as ``"L11_QMOD_ZONE_GAUGES"`` ordered as :attr:`MHM.gauge_ids`.
+        Gauges not located on an active L11 cell are skipped with a warning.
+        By default None
+    file : str, optional
+        Path of a NetCDF file to write the outputs given by ``file_names``
+        to directly, without FINAM links. Outputs are handed to a background
+        thread through a bounded queue and written in time chunks of about 1 MB
+        with compression, while mHM keeps running. Outputs are written at the
+        start time and after each update, aggregated outputs at the end of
+        their intervals. Needs the optional dependency netCDF4. By default None
+    file_names : list of str, optional
+        Names or glob patterns of the outputs to write to ``file``.
+        By default None (all outputs)
+
+    Raises
+    ------
+    ValueError
+        If a given data type is invalid.
+    ValueError
+        If a given aggregation is invalid.
+    ValueError
+        If a given zone name is reserved.
+    """
+
+    def __init__(
+        self,
+        names=None,
+        dtype=None,
+        compressed=False,
+        reuse_buffers=False,
+        aggregate=None,
+        zones=None,
+        file=None,
+        file_names=None,
+    ):
+        self.names = None if names is None else list(names)
+        self.dtype = dict(dtype) if isinstance(dtype, dict) else dtype
+        self.compressed = compressed
+        self.reuse_buffers = reuse_buffers and not compressed
+        self.aggregate = {} if aggregate is None else dict(aggregate)
+        self.zones = {} if zones is None else dict(zones)
+        self.file = file
+        self.file_names = None if file_names is None else list(file_names)
+        dtypes = self.dtype.values() if isinstance(self.dtype, dict) else [self.dtype]
+        for out_dtype in dtypes:
+            if out_dtype is not None and np.dtype(out_dtype).kind != "f":
+                msg = f"mHM: output data type needs to be floating, got {out_dtype}"
+                raise ValueError(msg)
+        for name, (method, interval) in self.aggregate.items():
+            if method not in AGGREGATION_METHODS:
+                msg = (
+                    f"mHM: aggregation method '{method}' for '{name}' is not available."
+                )
+                raise ValueError(msg)
+            if interval <= timedelta(0):
+                msg = f"mHM: aggregation interval for '{name}' needs to be positive."
+                raise ValueError(msg)
+        if _GAUGES in self.zones:
+            msg = f"mHM: zone name '{_GAUGES}' is reserved for the evaluation gauges."
+            raise ValueError(msg)
+
+
+class MeteoOptions:
+    """
+    Options for the meteo inputs of :class:`MHM`.
+
+    Parameters
+    ----------
+    files : dict, optional
+        Meteo inputs read directly from files instead of being coupled
+        via FINAM, given by input name (e.g. "METEO_PRE", case-insensitive)
+        and file path.
+        NumPy ".npy" files are memory-mapped and need to hold the grids on L1
+        ("ij" indexing) for every meteo time-step starting at the start time
+        of mHM. NetCDF files need a variable named like the input without
+        prefix in lower case (e.g. "pre") with the same layout and a "time"
+        coordinate. NetCDF files need the optional dependency netCDF4.
+        Values need to be in the units given by :any:`INPUT_UNITS`
+        and ``meteo_timestep`` is needed. By default None
+    prefetch : int, optional
+        Pull meteo inputs in a background thread up to the given number of
+        meteo time-steps ahead while mHM is running. Only data up to the next
+        coupling time is prefetched, so this is useful with a coupling step
+        larger than the meteo time-step and costly pulls, e.g. through adapters.
+        By default None
+    regrid : bool, optional
+        Remap meteo inputs on rectilinear grids that are not compatible with L1
+        (e.g. different resolution or extent) to the active cells of L1
+        with area weights precomputed on the first pull.
+        Grids need to use the same coordinate system. By default False
+
+    Raises
+    ------
+    ValueError
+        If a given meteo input file is not a meteo input.
+    """
+
+    def __init__(self, files=None, prefetch=None, regrid=False):
+        files = {} if files is None else dict(files)
+        self.files = {name.upper(): path for name, path in files.items()}
+        self.prefetch = prefetch
+        self.regrid = regrid
+        for name in self.files:
+            if not name.startswith("METEO") or name not in INPUT_UNITS:
+                msg = f"mHM: meteo input '{name}' is not available."
+                raise ValueError(msg)
+
+
+class ProfileOptions:
+    """
+    Options to profile :class:`MHM`.
+
+    Profiling collects cumulative timers and counters for the phases
+    of the component and every output, see :meth:`MHM.profile_stats`.
+
+    Parameters
+    ----------
+    interval : int, optional
+        Log the profile statistics every given number of updates.
+        By default None
+    file : str, optional
+        Path of a CSV file to write the profile statistics to when finalizing.
+        By default None
+    """
+
+    def __init__(self, interval=None, file=None):
+        self.interval = interval
+        self.file = file
+
+
+class RestartOptions:
+    """
+    Options to restore and save the state of :class:`MHM`.
+
+    States are saved with the restart files of mHM and mRM
+    together with the time of the component.
+
+    Parameters
+    ----------
+    read : str, optional
+        Directory with a state saved with ``write`` to start mHM from,
+        e.g. after a spin-up run. mHM starts at the time of the state without
+        warming days and the restart options of the namelist are overwritten.
+        States can only be restored at midnight. By default None
+    write : str, optional
+        Directory to save the state of mHM and the component time to when
+        the component is finalized. States can only be saved at midnight,
+        otherwise a warning is logged and no state is saved. By default None
+    """
+
+    def __init__(self, read=None, write=None):
+        self.read = read
+        self.write = write
+
+
+class CacheOptions:
+    """
+    Options to cache setup data of :class:`MHM` across runs.
+
+    Parameters
+    ----------
+    metadata : str, optional
+        Directory to cache the parsed mHM namelist, grid specifications,
+        masks and gauge locations in to speed up repeated starts of the same
+        setup, e.g. in calibration loops. Cache files are identified by a hash of
+        the working directory and the mHM namelist and are renewed when the
+        morphology or land cover files change. By default None
+    regrid : str, optional
+        Directory to cache the weights of remapped meteo inputs in
+        (see :class:`MeteoOptions`), identified by a hash of the grids,
+        to skip computing them in repeated runs. By default None
+    """
+
+    def __init__(self, metadata=None, regrid=None):
+        self.metadata = metadata
+        self.regrid = regrid
@@ -0,0 +1,490 @@
+"""
+Output handling of the mHM component.
+"""
+
+import fnmatch
+from functools import partial
+
+import finam as fm
+import mhm
+import numpy as np
+
+from .constants import (
+    MRM_OUTPUT_META,
+    OUTPUT_CALC,
+    OUTPUT_CALC_HORIZON,
+    OUTPUT_CALC_HORIZONS_META,
+    OUTPUT_CALC_META,
+    OUTPUT_HORIZONS_META,
+    OUTPUT_META,
+)
+from .writer import _OutputWriter
+
+# separator of output and zone name in zone outputs
+_ZONE = "_ZONE_"
+# meta data not written as attributes to output files
+_FILE_SKIP_ATTRS = ("units", "missing_value", "_FillValue", "dtype")
+
+
+def _horizon_name(name, horizon):
+    return name + "_L" + str(horizon).zfill(2)
+
+
+def _zone_name(name, zone):
+    return name + _ZONE + zone
+
+
+def _is_zone(grid_name):
+    return grid_name.startswith(_ZONE[1:])
+
+
+def _get_grid_name(var):
+    if _ZONE in var:
+        # zone outputs have their own 1D grid per zone definition
+        return _ZONE[1:] + var.split(_ZONE, 1)[1]
+    grid_name = var.split("_")[0]
+    return "L1" if grid_name == "METEO" else grid_name
+
+
+def _get_scatter(mask, no_data):
+    """Flat cell index and masked template to fill compressed values into a grid."""
+    template = np.ma.array(
+        np.full(mask.shape, no_data, dtype=float), mask=mask, fill_value=no_data
+    )
+    return np.flatnonzero(~mask), template
+
+
+def _get_points(grid, mask):
+    """Unstructured points at the cell centers of the active cells of a grid."""
+    cells = np.ravel_multi_index(np.nonzero(~mask), grid.data_shape, order=grid.order)
+    return fm.UnstructuredPoints(
+        points=grid.cell_centers[cells], axes_names=grid.axes_names, crs=grid.crs
+    )
+
+
+def _fill_grid(values, scatter, dtype=float):
+    """Scatter compressed values into a copy of the masked template."""
+    index, template = scatter
+    # values are cast while filling the copy
+    output = template.astype(dtype)
+    np.put(output.data, index, values)
+    return output
+
+
+def _match_names(patterns, names):
+    """Names matching any of the given names or glob patterns."""
+    selected = set()
+    for pattern in patterns:
+        # output names are upper case, zone names are matched as given
+        pos = pattern.upper().find(_ZONE)
+        if pos < 0:
+            pattern = pattern.upper()
+        else:
+            pattern = pattern[:pos].upper() + _ZONE + pattern[pos + len(_ZONE) :]
+        matches = [name for name in names if fnmatch.fnmatchcase(name, pattern)]
+        if not matches:
+            msg = f"mHM: output '{pattern}' is not available."
+            raise ValueError(msg)
+        selected.update(matches)
+    return [name for name in names if name in selected]
+
+
+def _get_dtype(dtype, name):
+    """Data type of an output given for all outputs or by output name."""
+    if isinstance(dtype, dict):
+        dtype = dtype.get(name)
+    return np.dtype(float if dtype is None else dtype)
+
+
+def _find_cells(grid, points):
+    """Flat ("ij") indices of the cells of a uniform grid containing the points."""
+    centers = grid.cell_centers
+    cells = [np.argmin(np.max(np.abs(centers - point), axis=1)) for point in points]
+    return np.ravel_multi_index(
+        np.unravel_index(cells, grid.data_shape, order=grid.order), grid.data_shape
+    )
+
+
+def _flat_index(cells, shape):
+    """Flat indices of cells given by flat or (i, j) indices."""
+    cells = np.asarray(cells, dtype=int)
+    if cells.ndim == 2:
+        return np.ravel_multi_index(tuple(cells.T), shape)
+    return cells
+
+
+def _cell_centers(grid):
+    """Cell centers along the axes of a uniform grid in the order of "ij" data."""
+    return [
+        ((axis[1:] + axis[:-1]) / 2)[:: 1 if increase else -1]
+        for axis, increase in zip(grid.axes, grid.axes_increase)
+    ]
+
+
+class _Zones:
+    """
+    Spatial means of compressed values over zones.
+
+    Zones are given by the compressed positions of their cells and
+    the zone label of each of them, so that zones can overlap.
+    """
+
+    def __init__(self, cells, labels, ids):
+        self.cells = cells
+        self.labels = labels
+        self.ids = ids
+        self.counts = np.bincount(labels, minlength=len(ids))
+
+    @classmethod
+    def from_definition(cls, definition, mask):
+        """
+        Create zones from a zone-ID raster or a list of cell indices per zone.
+
+        Cells outside of the mask or with negative zone IDs are ignored.
+        """
+        if not isinstance(definition, np.ndarray):
+            position = np.full(mask.size, -1)
+            position[np.flatnonzero(~mask)] = np.arange(np.sum(~mask))
+            zones = [position[_flat_index(zone, mask.shape)] for zone in definition]
+            zones = [zone[zone >= 0] for zone in zones]
+            cells = np.concatenate(zones).astype(int)
+            labels = np.repeat(np.arange(len(zones)), [len(zone) for zone in zones])
+            return cls(cells, labels, np.arange(len(zones)))
+        raster = np.ma.filled(np.ma.asarray(definition), -1)
+        if raster.shape != mask.shape:
+            msg = f"mHM: zone raster needs shape {mask.shape}, got {raster.shape}"
+            raise ValueError(msg)
+        zone_ids = raster[~mask].astype(int)
+        cells = np.flatnonzero(zone_ids >= 0)
+        ids, labels = np.unique(zone_ids[cells], return_inverse=True)
+        return cls(cells, labels, ids)
+
+    def mean(self, values):
+        """Mean of compressed values for each zone."""
+        sums = np.bincount(
+            self.labels, weights=values[self.cells], minlength=len(self.ids)
+        )
+        return sums / self.counts
+
+
+class _OutputBuffers:
+    """
+    Preallocated grid buffers of an output that are filled in place.
+
+    A buffer is only reused when the output doesn't hold data pushed with it
+    anymore, so the pool grows to the number of data sets retained by the
+    output and stays constant afterwards. Pushed data are read-only views.
+    """
+
+    def __init__(self, scatter, dtype=float):
+        self.index, template = scatter
+        self.template = template.astype(dtype)
+        self.buffers = []
+
+    def _acquire(self, output):
+        held = [
+            np.ma.getdata(data.magnitude)
+            for _, data in output.data
+            if not isinstance(data, str)
+        ]
+        for buffer in self.buffers:
+            if not any(np.may_share_memory(buffer.data, data) for data in held):
+                return buffer
+        self.buffers.append(self.template.copy())
+        return self.buffers[-1]
+
+    def fill(self, values, output):
+        """Fill compressed values into a free buffer of the output."""
+        buffer = self._acquire(output)
+        np.put(buffer.data, self.index, values)
+        view = buffer.view()
+        view.flags.writeable = False
+        return view
+
+
+class _VariableCache:
+    """
+    Step-scoped cache for compressed mHM variables.
+
+    Derived outputs share the variables fetched from mHM,
+    so each of them is only copied once per time step.
+    The cache needs to be cleared after each mHM time step.
+    """
+
+    def __init__(self, profiler):
+        self._data = {}
+        self._profiler = profiler
+
+    def clear(self):
+        """Invalidate all cached variables."""
+        self._data.clear()
+
+    def get(self, name, index=1):
+        """Get a compressed variable from mHM for the current time step."""
+        key = (name, index)
+        if key not in self._data:
+            with self._profiler.timer("get_variable"):
+                self._data[key] = mhm.get_variable(name, index=index, compressed=True)
+        return self._data[key]
+
+    def get_horizons(self, name):
+        """Get a compressed variable for all horizons with shape (cells, horizons)."""
+        key = (name, None)
+        if key not in self._data:
+            horizons = range(1, mhm.get.number_of_horizons() + 1)
+            self._data[key] = np.stack(
+                [self.get(name, index=n) for n in horizons], axis=1
+            )
+        return self._data[key]
+
+    def calc(self, func):
+        """Get the result of a derived output function for the current time step."""
+        if func not in self._data:
+            with self._profiler.timer("calc:" + func.__name__.lstrip("_")):
+                self._data[func] = func(self)
+        return self._data[func]
+
+
+class _Aggregation:
+    """
+    Temporal aggregation of a compressed output over mHM time-steps.
+
+    Values are accumulated in a preallocated buffer until the aggregate
+    is taken at the end of each interval.
+    """
+
+    def __init__(self, method, interval, time, size):
+        self.method = method
+        self.interval = interval
+        self.time = time + interval
+        self.data = np.zeros(size, dtype=float)
+        self.count = 0
+
+    def add(self, values):
+        """Add the values of the current time step."""
+        if self.count == 0:
+            self.data[:] = values
+        elif self.method in ("sum", "mean"):
+            self.data += values
+        elif self.method == "max":
+            np.maximum(self.data, values, out=self.data)
+        else:
+            np.minimum(self.data, values, out=self.data)
+        self.count += 1
+
+    def pop(self):
+        """Get the aggregate and start the next interval."""
+        if self.method == "mean":
+            result = self.data / max(self.count, 1)
+        else:
+            result = self.data.copy()
+        self.count = 0
+        self.time += self.interval
+        return result
+
+
+class _Outputs:
+    """
+    Data of the outputs of the mHM component.
+
+    Provides the compressed data of the outputs for the current time-step
+    through a step-scoped variable cache, calculates zone means and temporal
+    aggregates and fills the data into grids or buffers for pushing
+    and into the writer of the output file.
+
+    Parameters
+    ----------
+    options : OutputOptions
+        Options for the outputs.
+    profiler : _Profiler
+        Profiler of the component.
+    """
+
+    def __init__(self, options, profiler):
+        self.options = options
+        self.profiler = profiler
+        self.cache = _VariableCache(profiler)
+        self.data = {}
+        self.no_data = None
+        self.scatter = {}
+        self.points = {}
+        self.zones = {}
+        self.zone_outputs = {}
+        self.gauge_ids = []
+        self.buffers = {}
+        self.aggregation = {}
+        self.written = set()
+        self.writer = None
+
+    def add_variables(self, horizons, mrm_active):
+        """Add the data functions of all mHM variables and derived outputs."""
+        get = self.cache.get
+        self.data = {var: partial(get, var) for var in OUTPUT_META}
+        if mrm_active:
+            self.data.update({var: partial(get, var) for var in MRM_OUTPUT_META})
+        self.data.update(
+            {
+                _horizon_name(var, horizon): partial(get, var, index=horizon)
+                for var in OUTPUT_HORIZONS_META
+                for horizon in horizons
+            }
+        )
+        self.data.update(
+            {var: partial(self._get_calc, var) for var in OUTPUT_CALC_META}
+        )
+        self.data.update(
+            {
+                _horizon_name(var, horizon): partial(self._get_calc, var, horizon)
+                for var in OUTPUT_CALC_HORIZONS_META
+                for horizon in horizons
+            }
+        )
+
+    def _get_calc(self, var, horizon=None):
+        """Get compressed values of a calculated output."""
+        if horizon is None:
+            return self.cache.calc(OUTPUT_CALC[var])
+        return self.cache.calc(OUTPUT_CALC_HORIZON[var])[:, horizon - 1]
+
+    def add_grids(self, masks, no_data):
+        """Add the flat cell index and masked template to fill each grid."""
+        self.no_data = no_data
+        for grid_name, mask in masks.items():
+            self.scatter[grid_name] = _get_scatter(mask, no_data)
+
+    def add_zone(self, zone, definition, names, mask):
+        """
+        Add the zone means of outputs on the grid with the given mask.
+
+        Returns
+        -------
+        tuple
+            Name and mask of the 1D grid of the zone.
+
+        Raises
+        ------
+        ValueError
+            If the zone definition is invalid.
+        """
+        for var in names:
+            if var not in self.data:
+                msg = f"mHM: output '{var}' for zone '{zone}' is not available."
+                raise ValueError(msg)
+        if len({_get_grid_name(var) for var in names}) > 1:
+            msg = f"mHM: outputs for zone '{zone}' need to be on the same grid."
+            raise ValueError(msg)
+        grid_name = _get_grid_name(_zone_name("", zone))
+        index = _Zones.from_definition(definition, mask)
+        if np.any(index.counts == 0) or len(index.ids) == 0:
+            msg = f"mHM: zones of '{zone}' need to contain active cells."
+            raise ValueError(msg)
+        self.zones[grid_name] = index
+        self.zone_outputs[zone] = list(names)
+        zone_mask = np.zeros(len(index.ids), dtype=bool)
+        self.scatter[grid_name] = _get_scatter(zone_mask, self.no_data)
+        for var in names:
+            self.data[_zone_name(var, zone)] = partial(
+                self._get_zone_mean, self.data[var], grid_name
+            )
+        return grid_name, zone_mask
+
+    def _get_zone_mean(self, get_data, grid_name):
+        """Get the zone means of an output."""
+        with self.profiler.timer("zones:" + grid_name):
+            return self.zones[grid_name].mean(get_data())
+
+    def select(self):
+        """Only keep the outputs matching the given output names."""
+        if self.options.names is None:
+            return
+        selected = _match_names(self.options.names, list(self.data))
+        self.data = {name: self.data[name] for name in selected}
+
+    def add_aggregation(self, time):
+        """Create the aggregation buffers for all outputs to aggregate."""
+        for name, (method, interval) in self.options.aggregate.items():
+            if name not in self.data:
+                msg = f"mHM: output '{name}' to aggregate is not available."
+                raise ValueError(msg)
+            size = len(self.scatter[_get_grid_name(name)][0])
+            self.aggregation[name] = _Aggregation(method, interval, time, size)
+
+    def dtype(self, name):
+        """Data type of an output."""
+        return _get_dtype(self.options.dtype, name)
+
+    def fill(self, values, name, output=None):
+        """
+        Scatter compressed values of an output into a masked grid array.
+
+        With reused buffers, the grid is filled into a free buffer of the
+        given FINAM output.
+        """
+        grid_name = _get_grid_name(name)
+        dtype = self.dtype(name)
+        if self.options.compressed or _is_zone(grid_name):
+            # compressed outputs and zone means are pushed as they are
+            return np.asarray(values, dtype=dtype)
+        if self.options.reuse_buffers and output is not None:
+            if name not in self.buffers:
+                self.buffers[name] = _OutputBuffers(self.scatter[grid_name], dtype)
+            return self.buffers[name].fill(values, output)
+        return _fill_grid(values, self.scatter[grid_name], dtype)
+
+    def aggregate(self, used):
+        """Add the current values of the used outputs to their aggregation."""
+        for name, aggregation in self.aggregation.items():
+            if used(name):
+                with self.profiler.timer("aggregate:" + name):
+                    aggregation.add(self.data[name]())
+
+    def get(self, name, time, finished):
+        """Compressed data of an output or None during an aggregation interval."""
+        if name not in self.aggregation:
+            with self.profiler.timer("data:" + name):
+                return self.data[name]()
+        aggregation = self.aggregation[name]
+        # aggregated data at the end of the interval or the run
+        if time < aggregation.time and not finished:
+            return None
+        return aggregation.pop()
+
+    def open_writer(self, time, gridspec, metas):
+        """Start the writer of the outputs written directly to a file."""
+        if self.options.file is None:
+            return
+        names = list(self.data)
+        if self.options.file_names is not None:
+            names = _match_names(self.options.file_names, names)
+        dims, variables = {}, {}
+        for name in names:
+            grid_name = _get_grid_name(name)
+            if _is_zone(grid_name):
+                var_dims, index = (grid_name.lower(),), None
+                dims[var_dims[0]] = self.zones[grid_name].ids
+            else:
+                var_dims = (f"y_{grid_name}", f"x_{grid_name}")
+                index = self.scatter[grid_name][0]
+                x, y = _cell_centers(gridspec[grid_name])
+                dims[var_dims[0]], dims[var_dims[1]] = y, x
+            attrs = {}
+            for att, val in metas[name].items():
+                if att == "units" and val is not None:
+                    attrs[att] = f"{val:~}"
+                elif att not in _FILE_SKIP_ATTRS and isinstance(val, (str, int, float)):
+                    attrs[att] = val
+            variables[name] = (var_dims, index, self.dtype(name), attrs)
+        self.written = set(names)
+        self.writer = _OutputWriter(
+            self.options.file, time, dims, variables, self.no_data
+        )
+        # initial values like pushed when connecting
+        self.writer.put(
+            time,
+            {name: self.data[name]() for name in names if name not in self.aggregation},
+        )
+
+    def close(self):
+        """Close the writer of the output file."""
+        if self.writer is not None:
+            self.writer.close()
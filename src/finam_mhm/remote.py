@@ -0,0 +1,327 @@
+"""
+FINAM mHM component hosting mHM in a worker process.
+"""
+
+import traceback
+from multiprocessing import get_context, shared_memory
+
+import finam as fm
+import mhm
+import numpy as np
+
+from .component import MHM
+from .meteo import _MeteoInputs
+from .options import MeteoOptions
+from .output import _get_grid_name, _is_zone, _Outputs
+from .tools import _MHM_STEP
+
+
+class _WorkerMHM(MHM):
+    """
+    mHM component running in the worker process of a :class:`RemoteMHM`.
+
+    Outputs are written to shared memory buffers instead of being pushed
+    and meteo data is read from shared memory buffers instead of being pulled.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.memory = []
+        self.linked = set()
+        self.pushed = []
+        self.slot = 0
+        self.output_buffers = {}
+        self.meteo_buffers = {}
+        self.meteo_times = []
+
+    def _pull_meteo(self, time):
+        data = {
+            var: self.meteo.readers[name].read(time)
+            for var, name in self.meteo.names.items()
+            if name in self.meteo.readers
+        }
+        if len(data) < len(self.meteo.names):
+            slot = self.meteo_times.index(time)
+            for var, name in self.meteo.coupled.items():
+                data[var] = self.meteo_buffers[name][slot]
+        return data
+
+    def _has_targets(self, name):
+        return name in self.linked
+
+    def _push_output(self, name, values):
+        self.output_buffers[name][self.slot][:] = values
+        self.pushed.append(name)
+
+    def _attach(self, shm_name, shape):
+        shm = shared_memory.SharedMemory(name=shm_name)
+        self.memory.append(shm)
+        return np.ndarray(shape, dtype=float, buffer=shm.buf)
+
+    def remote_info(self):
+        """Information to set up the remote component."""
+        return {
+            "time": self.time,
+            "step": self.step,
+            # meteo inputs read from files are not transferred
+            "meteo": (
+                list(self.meteo.coupled.values()),
+                self.meteo.timestep,
+                MeteoOptions(regrid=self.meteo.options.regrid),
+                self.meteo.ignore_grid,
+                self.meteo.regrid_cache,
+            ),
+            "output": self.output.options,
+            "gridspec": self.gridspec,
+            "no_data": self.no_data,
+            "masks": self.masks,
+            "outputs": {name: self.outputs[name].info for name in self.output_data},
+            "inputs": {name: self.inputs[name].info for name in self.INPUT_NAMES},
+            # steps run past the end of the composition must not reach files
+            "run_ahead": not (
+                self.meteo.names
+                or self.restart.write is not None
+                or self.output.options.file is not None
+            ),
+        }
+
+    def remote_attach(self, outputs, meteo):
+        """Attach to the shared memory buffers created by the remote component."""
+        for name, shm_names in outputs.items():
+            size = len(self.output.scatter[_get_grid_name(name)][0])
+            self.output_buffers[name] = [self._attach(n, (size,)) for n in shm_names]
+        for name, (shm_name, shape) in meteo.items():
+            self.meteo_buffers[name] = self._attach(shm_name, shape)
+
+    def remote_connect(self, linked):
+        """Write initial data of linked outputs to the first buffers."""
+        self.linked = set(linked)
+        self.slot = 0
+        for name in self.linked:
+            self._push_output(name, self.output_data[name]())
+        return mhm.run.finished()
+
+    def remote_update(self, slot, meteo_times):
+        """Update the component and write pushed outputs to the given buffers."""
+        self.slot = slot
+        self.meteo_times = meteo_times
+        self.pushed = []
+        self.update()
+        return self.time, self.pushed, mhm.run.finished()
+
+    def remote_finalize(self):
+        """Finalize the component and release the shared memory."""
+        self.finalize()
+        # views need to be released before closing the shared memory
+        self.output_buffers.clear()
+        self.meteo_buffers.clear()
+        for shm in self.memory:
+            shm.close()
+
+
+def _serve(conn, kwargs):
+    """Serve an mHM component in a worker process."""
+    try:
+        model = _WorkerMHM(**kwargs)
+        model.initialize()
+        conn.send(("info", model.remote_info()))
+        commands = {
+            "attach": model.remote_attach,
+            "connect": model.remote_connect,
+            "update": model.remote_update,
+            "finalize": model.remote_finalize,
+        }
+        while True:
+            command, args = conn.recv()
+            conn.send((command, commands[command](*args)))
+            if command == "finalize":
+                break
+    except Exception:  # pylint: disable=W0718
+        conn.send(("error", traceback.format_exc()))
+    finally:
+        conn.close()
+
+
+class RemoteMHM(fm.TimeComponent):
+    """
+    mHM FINAM compoment hosting mHM in a worker process.
+
+    The component has the same inputs and outputs as :class:`MHM`.
+    Grids are exchanged with the worker through shared memory buffers
+    and only small control messages are sent through a pipe.
+    This way, multiple mHM domains can be used in one composition.
+    Without meteo inputs, restart files and an output file, the worker
+    already runs the next time-step while outputs are pushed and other
+    components are updated. Otherwise, it only steps when updated, so that
+    it never reads or writes files past the end of the composition.
+
+    Scripts using this component need to guard the main code
+    with ``if __name__ == "__main__":``.
+
+    Parameters
+    ----------
+    **kwargs
+        Keyword arguments for :class:`MHM`.
+
+    Raises
+    ------
+    RuntimeError
+        If mHM failed in the worker process.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__()
+        self.kwargs = kwargs
+        self.step = None
+        self.meteo = None
+        self.output = None
+        self.masks = {}
+        self.memory = {}
+        self.output_buffers = {}
+        self.meteo_buffers = {}
+        self.linked = None
+        self.slot = 0
+        self.pending = False
+        self.run_ahead = False
+        self.finished = False
+        self._conn = None
+        self._process = None
+
+    def _next_time(self):
+        """Next pull time."""
+        return self.time + self.step
+
+    def _receive(self):
+        """Receive the result of the last command from the worker."""
+        command, result = self._conn.recv()
+        if command == "error":
+            msg = f"mHM: worker process failed:\n{result}"
+            raise RuntimeError(msg)
+        return result
+
+    def _call(self, command, *args):
+        """Call a command in the worker and wait for the result."""
+        self._conn.send((command, args))
+        return self._receive()
+
+    def _share(self, name, shape):
+        """Create a shared memory buffer."""
+        size = max(int(np.prod(shape)) * 8, 1)
+        self.memory[name] = shared_memory.SharedMemory(create=True, size=size)
+        return np.ndarray(shape, dtype=float, buffer=self.memory[name].buf)
+
+    def _initialize(self):
+        # mHM can't be safely forked after it was used in this process
+        context = get_context("spawn")
+        self._conn, child_conn = context.Pipe()
+        self._process = context.Process(
+            target=_serve, args=(child_conn, self.kwargs), daemon=True
+        )
+        self._process.start()
+        child_conn.close()
+        info = self._receive()
+        self.time = info["time"]
+        self.step = info["step"]
+        self.run_ahead = info["run_ahead"]
+        self.masks = info["masks"]
+        self.meteo = _MeteoInputs(*info["meteo"])
+        self.meteo.open(self.time, info["gridspec"]["L1"], self.masks["L1"])
+        # outputs are only filled into grids, profiling is done by the worker
+        self.output = _Outputs(info["output"], None)
+        self.output.add_grids(self.masks, info["no_data"])
+        # double buffers for outputs and one slot per meteo time in a step
+        for name in info["outputs"]:
+            size = len(self.output.scatter[_get_grid_name(name)][0])
+            self.output_buffers[name] = [
+                self._share(f"{name}_{slot}", (size,)) for slot in range(2)
+            ]
+        slots = self.step // (_MHM_STEP * (self.meteo.timestep or 1)) + 1
+        for name in self.meteo.names.values():
+            shape = (slots,) + self.masks["L1"].shape
+            self.meteo_buffers[name] = self._share(name, shape)
+        self._call(
+            "attach",
+            {
+                name: [self.memory[f"{name}_{slot}"].name for slot in range(2)]
+                for name in self.output_buffers
+            },
+            {
+                name: (self.memory[name].name, buffer.shape)
+                for name, buffer in self.meteo_buffers.items()
+            },
+        )
+        for name, out_info in info["outputs"].items():
+            self.outputs.add(name=name, info=out_info)
+        for name, in_info in info["inputs"].items():
+            self.inputs.add(name=name, info=in_info)
+        self.create_connector()
+
+    def _get_output(self, name, slot):
+        """Get the data of an output from the given buffer."""
+        values = self.output_buffers[name][slot]
+        if self.output.options.compressed or _is_zone(_get_grid_name(name)):
+            # buffers are reused and can't be pushed directly
+            return values.astype(self.output.dtype(name))
+        return self.output.fill(values, name, self.outputs[name])
+
+    def _connect(self, start_time):
+        push_data = {}
+        if self.linked is None:
+            self.linked = [
+                n for n in self.output_buffers if self.outputs[n].has_targets
+            ]
+            self.finished = self._call("connect", self.linked)
+            # pushing to outputs without targets does nothing
+            push_data = {
+                name: self._get_output(name, 0) if name in self.linked else None
+                for name, required in self.connector.data_required.items()
+                if required
+            }
+        self.try_connect(start_time=start_time, push_data=push_data)
+        self.meteo.connect(self.inputs)
+
+    def _request_update(self):
+        """Request the next update from the worker without waiting."""
+        meteo_times = []
+        if self.meteo.names:
+            meteo_times = self.meteo.times(self.time, self.next_time)
+        for slot, time in enumerate(meteo_times):
+            for name in self.meteo.names.values():
+                data = self.inputs[name].pull_data(time + _MHM_STEP)[0]
+                data = self.meteo.convert(name, self.inputs[name].info, data.magnitude)
+                self.meteo_buffers[name][slot] = np.ma.getdata(data)
+        self.slot = 1 - self.slot
+        self._conn.send(("update", (self.slot, meteo_times)))
+        self.pending = True
+
+    def _update(self):
+        if self.finished:
+            return
+        if not self.pending:
+            self._request_update()
+        self.time, pushed, self.finished = self._receive()
+        self.pending = False
+        slot = self.slot
+        # let the worker run the next step while outputs are pushed
+        if self.run_ahead and not self.finished:
+            self._request_update()
+        for name in pushed:
+            self.outputs[name].push_data(
+                data=self._get_output(name, slot), time=self.time
+            )
+        if self.finished:
+            self.status = fm.ComponentStatus.FINISHED
+
+    def _finalize(self):
+        if self.pending:
+            self._receive()
+            self.pending = False
+        self._call("finalize")
+        self._process.join()
+        self._conn.close()
+        # views need to be released before closing the shared memory
+        self.output_buffers.clear()
+        self.meteo_buffers.clear()
+        for shm in self.memory.values():
+            shm.close()
+            shm.unlink()
@@ -0,0 +1,220 @@
+"""
+Tools of the mHM component for profiling, caching and namelists.
+"""
+
+import copy
+import csv
+import fnmatch
+import hashlib
+import os
+import pickle
+import tempfile
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+
+# mHM always has hourly stepping
+_MHM_STEP = timedelta(hours=1)
+# namelist values holding paths relative to the working directory of mHM
+_PATH_KEYS = ("dir*", "file_*", "path_*", "*_file_restart*")
+# files of a saved mHM state (restart files of mHM and mRM and component time)
+_STATE_FILES = {"mhm": "mHM_restart.nc", "mrm": "mRM_restart.nc", "time": "time.txt"}
+# namelist groups of the restart options if they are not set in the namelist
+_RESTART_GROUPS = {
+    "read_restart": "mainconfig_mhm_mrm",
+    "write_restart": "mainconfig_mhm_mrm",
+    "mhm_file_restartin": "mainconfig_mhm_mrm",
+    "mrm_file_restartin": "mainconfig_mhm_mrm",
+    "mhm_file_restartout": "directories_general",
+    "mrm_file_restartout": "directories_general",
+    "warming_days": "time_periods",
+}
+
+
+def _first(value):
+    """First entry of a namelist value that could be an array."""
+    return value[0] if isinstance(value, list) else value
+
+
+def _patch_namelist(nml, **values):
+    """Set the first entries of namelist values in the groups defining them."""
+    for key, value in values.items():
+        group = next((g for g in nml if key in nml[g]), _RESTART_GROUPS[key])
+        if group not in nml:
+            nml[group] = {}
+        if isinstance(nml[group].get(key), list):
+            nml[group][key][0] = value
+        else:
+            nml[group][key] = value
+
+
+def _absolute_paths(nml, cwd):
+    """Join the paths in the namelist to the working directory of mHM."""
+    for group in nml.values():
+        for key, value in group.items():
+            if not any(fnmatch.fnmatch(key, pattern) for pattern in _PATH_KEYS):
+                continue
+            if isinstance(value, list):
+                for i, path in enumerate(value):
+                    if isinstance(path, str):
+                        # keep trailing separators of directories
+                        value[i] = os.path.join(cwd, path)
+            elif isinstance(value, str):
+                group[key] = os.path.join(cwd, value)
+
+
+def _join_paths(options, cwd, *keys):
+    """Copy of options with the given relative paths joined to the working directory."""
+    options = copy.copy(options)
+    for key in keys:
+        value = getattr(options, key)
+        if isinstance(value, dict):
+            value = {name: cwd / path for name, path in value.items()}
+        elif value is not None:
+            value = cwd / value
+        setattr(options, key, value)
+    return options
+
+
+def _read_state_time(path):
+    """Read the time of a saved mHM state."""
+    file = Path(path) / _STATE_FILES["time"]
+    if not file.exists():
+        msg = f"mHM: no saved state found in '{path}'"
+        raise ValueError(msg)
+    time = datetime.fromisoformat(file.read_text(encoding="utf-8").strip())
+    if time.hour != 0:
+        msg = f"mHM: can only restart from states at midnight, got {time}"
+        raise ValueError(msg)
+    return time
+
+
+def _input_files(config, cwd):
+    """Size and modification time of the morphology and land cover files."""
+    dirs = config.get("directories_general", {})
+    files = []
+    for key in ("dir_morpho", "dir_lcover"):
+        values = dirs.get(key) or []
+        for directory in values if isinstance(values, list) else [values]:
+            path = Path(cwd) / str(directory or ".")
+            for file in sorted(path.glob("*")) if path.is_dir() else []:
+                stat = file.stat()
+                files.append((str(file), stat.st_size, stat.st_mtime_ns))
+    return files
+
+
+def _read_asc(path):
+    """Read the data of an ESRI ASCII grid with "ij" indexing."""
+    with open(path, encoding="utf-8") as file:
+        lines = file.readlines()
+    header = 0
+    while lines[header].split()[0][0].isalpha():
+        header += 1
+    return np.loadtxt(lines[header:], ndmin=2)
+
+
+class _Timer:
+    """Context manager adding the elapsed time to a profiler entry."""
+
+    def __init__(self, profiler, key):
+        self.profiler = profiler
+        self.key = key
+        self.start = None
+
+    def __enter__(self):
+        self.start = perf_counter()
+
+    def __exit__(self, *args):
+        self.profiler.add(self.key, self.start)
+
+
+class _Profiler:
+    """
+    Cumulative timers and counters for the phases of the component.
+
+    Profilers are active if options are given.
+    Inactive profilers only hand out a shared null context.
+    """
+
+    _null = nullcontext()
+
+    def __init__(self, options=None):
+        self.active = options is not None
+        self.interval = None if options is None else options.interval
+        self.path = None if options is None else options.file
+        self.stats = {}
+
+    def timer(self, key):
+        """Context manager to time a phase."""
+        return _Timer(self, key) if self.active else self._null
+
+    def add(self, key, start):
+        """Add the time elapsed since start to a phase."""
+        if self.active:
+            count, total = self.stats.get(key, (0, 0.0))
+            self.stats[key] = (count + 1, total + perf_counter() - start)
+
+    def summary(self):
+        """Count, total time and mean time of all phases."""
+        return {
+            key: {"count": count, "time": total, "mean": total / count}
+            for key, (count, total) in self.stats.items()
+        }
+
+    def write(self):
+        """Write the summary to the CSV file."""
+        with open(self.path, "w", newline="", encoding="utf-8") as file:
+            writer = csv.writer(file)
+            writer.writerow(["name", "count", "time", "mean"])
+            for key, stat in self.summary().items():
+                writer.writerow([key, stat["count"], stat["time"], stat["mean"]])
+
+
+class _MetadataCache:
+    """
+    On-disk cache of the parsed namelist and the grid metadata of an mHM setup.
+
+    Entries are stored in a pickle file identified by a hash of the working
+    directory and the mHM namelist. They are discarded if the morphology
+    or land cover files changed in size or modification time.
+    Without a directory, entries are only kept in memory.
+    """
+
+    def __init__(self, directory, cwd, namelist):
+        cwd = Path(cwd).resolve()
+        self.path = None
+        self.cwd = cwd
+        self.data = {}
+        self.changed = False
+        if directory is None:
+            return
+        sha = hashlib.sha1(str(cwd).encode())
+        sha.update((cwd / namelist).read_bytes())
+        self.path = Path(directory).resolve() / f"metadata_{sha.hexdigest()}.pkl"
+        if self.path.exists():
+            with open(self.path, "rb") as file:
+                data = pickle.load(file)
+            if data.get("inputs") == _input_files(data["config"], cwd):
+                self.data = data
+
+    def get(self, key, func):
+        """Get an entry or calculate and store it with the function."""
+        if key not in self.data:
+            self.data[key] = func()
+            self.changed = True
+        return self.data[key]
+
+    def save(self):
+        """Write the cache file if entries were added."""
+        if self.path is None or not self.changed:
+            return
+        self.data["inputs"] = _input_files(self.data["config"], self.cwd)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # replace atomically for concurrent runs of the same setup
+        with tempfile.NamedTemporaryFile(dir=self.path.parent, delete=False) as file:
+            pickle.dump(self.data, file)
+        os.replace(file.name, self.path)
+        self.changed = False
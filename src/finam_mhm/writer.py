@@ -0,0 +1,162 @@
+"""
+Direct NetCDF output of the mHM component.
+"""
+
+from queue import Queue
+from threading import Thread
+
+import numpy as np
+
+from .meteo import _NETCDF_LOCK
+
+# target size of a chunk in bytes
+_CHUNK_BYTES = 2**20
+# maximal number of time-steps in a chunk
+_MAX_CHUNK = 24 * 31
+
+
+class _OutputWriter:
+    """
+    Background thread writing outputs to a chunked and compressed NetCDF file.
+
+    Outputs of a time-step are handed over through a bounded queue, so the
+    model only waits when the writer falls behind. Time-steps are collected
+    in memory until a time chunk is full and written chunk by chunk.
+    Outputs missing in a time-step are written as no-data.
+    Errors while writing are raised by :meth:`put` and :meth:`close`.
+
+    Parameters
+    ----------
+    path : pathlike
+        Path of the NetCDF file.
+    start : datetime.datetime
+        Reference time of the time coordinate in hours.
+    dims : dict
+        Coordinate values by dimension name.
+    variables : dict
+        Dimensions, scatter index (or None for values pushed as they are),
+        data type and attributes by output name.
+    no_data : float
+        No-data value.
+    size : int, optional
+        Maximal number of queued time-steps, by default 16
+    """
+
+    def __init__(self, path, start, dims, variables, no_data, size=16):
+        try:
+            import netCDF4  # pylint: disable=C0415
+        except ImportError as err:
+            msg = f"mHM: writing outputs to '{path}' requires netCDF4."
+            raise ImportError(msg) from err
+        self.path = path
+        self.start = start
+        self.dims = dims
+        self.variables = variables
+        self.no_data = no_data
+        step_bytes = max(
+            np.dtype(dtype).itemsize * np.prod([len(dims[d]) for d in var_dims])
+            for var_dims, __, dtype, __ in variables.values()
+        )
+        self.chunk = int(np.clip(_CHUNK_BYTES // step_bytes, 1, _MAX_CHUNK))
+        self.error = None
+        self.queue = Queue(maxsize=size)
+        self.thread = Thread(target=self._run, args=(netCDF4,), daemon=True)
+        self.thread.start()
+
+    def _create(self, netCDF4):
+        """Create the file with all dimensions and variables."""
+        file = netCDF4.Dataset(self.path, "w")
+        file.createDimension("time", None)
+        time = file.createVariable("time", "f8", ("time",))
+        time.units = f"hours since {self.start.isoformat(sep=' ')}"
+        time.calendar = "standard"
+        for dim, values in self.dims.items():
+            file.createDimension(dim, len(values))
+            file.createVariable(dim, np.asarray(values).dtype, (dim,))[:] = values
+        for name, (var_dims, __, dtype, attrs) in self.variables.items():
+            shape = tuple(len(self.dims[d]) for d in var_dims)
+            var = file.createVariable(
+                name,
+                dtype,
+                ("time",) + var_dims,
+                zlib=True,
+                complevel=4,
+                shuffle=True,
+                chunksizes=(self.chunk,) + shape,
+                fill_value=self.no_data,
+            )
+            var.setncatts(attrs)
+        return file
+
+    def _run(self, netCDF4):
+        file, buffers, times, written = None, {}, [], 0
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                # keep draining the queue to not block the model
+                continue
+            try:
+                if file is None:
+                    with _NETCDF_LOCK:
+                        file = self._create(netCDF4)
+                    buffers = self._buffers()
+                time, data = item
+                self._fill(buffers, len(times), data)
+                times.append(time)
+                if len(times) == self.chunk:
+                    self._write(file, buffers, times, written)
+                    written += len(times)
+                    times = []
+            except Exception as err:  # pylint: disable=W0718
+                self.error = err
+        try:
+            if file is not None and self.error is None and times:
+                self._write(file, buffers, times, written)
+        except Exception as err:  # pylint: disable=W0718
+            self.error = err
+        finally:
+            if file is not None:
+                with _NETCDF_LOCK:
+                    file.close()
+
+    def _buffers(self):
+        """Buffers for the time-steps of a chunk filled with no-data."""
+        buffers = {}
+        for name, (var_dims, __, dtype, __) in self.variables.items():
+            shape = (self.chunk,) + tuple(len(self.dims[d]) for d in var_dims)
+            buffers[name] = np.full(shape, self.no_data, dtype=dtype)
+        return buffers
+
+    def _fill(self, buffers, row, data):
+        """Fill the data of a time-step into a row of the buffers."""
+        for name, (__, index, __, __) in self.variables.items():
+            values = data.get(name, self.no_data)
+            if index is None:
+                buffers[name][row] = values
+            else:
+                # masked cells keep the no-data value
+                buffers[name][row].reshape(-1)[index] = values
+
+    def _write(self, file, buffers, times, written):
+        """Write the buffered time-steps to the file."""
+        hours = [(time - self.start).total_seconds() / 3600 for time in times]
+        with _NETCDF_LOCK:
+            file["time"][written : written + len(times)] = hours
+            for name, buffer in buffers.items():
+                file[name][written : written + len(times)] = buffer[: len(times)]
+            file.sync()
+
+    def put(self, time, data):
+        """Queue the outputs of a time-step given by output name."""
+        if self.error is not None:
+            raise self.error
+        self.queue.put((time, data))
+
+    def close(self):
+        """Write the remaining time-steps and close the file."""
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
@@ -1,8 +1,10 @@
 import os
 import shutil
+import tempfile
 import unittest
 from datetime import datetime, timedelta
 from pathlib import Path
+from unittest import mock
 
 import finam as fm
 import mhm
@@ -11,6 +13,11 @@ from numpy.testing import assert_allclose
 
 import finam_mhm as fm_mhm
 
+try:
+    import netCDF4
+except ImportError:
+    netCDF4 = None
+
 
 def str2date(dtstr):
     return datetime.fromisoformat(dtstr)
@@ -32,6 +39,68 @@ class TestMHM(unittest.TestCase):
     def tearDownClass(self):
         shutil.rmtree(self.test_domain)
 
+    def ref_runoff(self):
+        """Hourly reference runoff at the cell (8, 4)."""
+        ref = np.genfromtxt(
+            self.here / "test_files/ref_runoff.csv",
+            names=True,
+            converters={0: str2date},
+            delimiter=",",
+            dtype=None,
+            encoding="utf-8",
+        )
+        return np.array([i[1] for i in ref])
+
+    def run_mhm(
+        self,
+        mhm,
+        start,
+        end,
+        step,
+        output="L1_TOTAL_RUNOFF",
+        index=(0, 8, 4),
+        inputs=(),
+    ):
+        """
+        Run mHM in a composition and collect an output at every step.
+
+        Outputs of the input components are linked to the mHM inputs of the
+        same name. Returns the values at the index or copies of the data.
+        """
+        data = []
+        consumer = fm.components.DebugConsumer(
+            inputs={"Output": fm.Info(time=None, grid=None, units=None)},
+            start=start,
+            step=step,
+            callbacks={
+                "Output": lambda _c, d, _t: data.append(
+                    d.magnitude.copy() if index is None else d.magnitude[index]
+                )
+            },
+        )
+        composition = fm.Composition([mhm, *inputs, consumer])
+        for component in inputs:
+            for name, out in component.outputs.items():
+                out >> mhm.inputs[name]
+        mhm.outputs[output] >> consumer.inputs["Output"]
+        composition.run(start_time=start, end_time=end)
+        return data if index is None else np.array(data)
+
+    def temp_path(self):
+        """Temporary directory removed after the test."""
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        return Path(tmp.name)
+
+    def daily_pre(self, start, func, grid=None, units="mm / d", mask=fm.Mask.FLEX):
+        """Generator of daily precipitation for the input "METEO_PRE"."""
+        info = fm.Info(time=None, grid=grid or fm.NoGrid(2), units=units, mask=mask)
+        return fm.components.CallbackGenerator(
+            callbacks={"METEO_PRE": (func, info)},
+            start=start,
+            step=timedelta(days=1),
+        )
+
     def test_run(self):
         start_date = datetime(1990, 1, 1)
         end_date = datetime(1991, 1, 1)
@@ -77,6 +146,884 @@ class TestMHM(unittest.TestCase):
 
         assert_allclose(ref, out)
 
+    def test_coupling_step(self):
+        mhm = fm_mhm.MHM(cwd=self.test_domain, coupling_step=timedelta(days=1))
+        out = self.run_mhm(
+            mhm, datetime(1990, 1, 1), datetime(1991, 1, 1), timedelta(days=1)
+        )
+
+        # daily values are the hourly values at midnight
+        assert_allclose(self.ref_runoff()[::24], out)
+
+    def test_aggregate(self):
+        start_date = datetime(1990, 1, 1)
+        end_date = datetime(1991, 1, 1)
+        path = self.temp_path() / "runoff_mean_out.csv"
+
+        mhm = fm_mhm.MHM(
+            cwd=self.test_domain,
+            output=fm_mhm.OutputOptions(
+                aggregate={"L1_TOTAL_RUNOFF": ("mean", timedelta(days=1))}
+            ),
+        )
+        csv = fm.components.CsvWriter(
+            path=path,
+            inputs=["Runoff"],
+            time_column="Time",
+            separator=",",
+            start=start_date,
+            step=timedelta(days=1),
+        )
+
+        composition = fm.Composition([mhm, csv])
+
+        (
+            mhm.outputs["L1_TOTAL_RUNOFF"]
+            >> fm.adapters.GridToValue(func=lambda x: x[0, 8, 4])
+            >> csv["Runoff"]
+        )
+
+        composition.run(start_time=start_date, end_time=end_date)
+
+        ref = np.genfromtxt(
+            self.here / "test_files/ref_runoff.csv",
+            names=True,
+            converters={0: str2date},
+            delimiter=",",
+            dtype=None,
+            encoding="utf-8",
+        )
+        ref = np.array([i[1] for i in ref])
+        # initial value followed by the daily means of the hourly values
+        ref = np.concatenate(([ref[0]], ref[1:].reshape(-1, 24).mean(axis=1)))
+        out = np.genfromtxt(
+            path,
+            names=True,
+            converters={0: str2date},
+            delimiter=",",
+            dtype=None,
+            encoding="utf-8",
+        )
+        out = np.array([i[1] for i in out])
+
+        assert_allclose(ref, out)
+
+    def test_invalid_aggregate(self):
+        with self.assertRaises(ValueError):
+            fm_mhm.MHM(
+                cwd=self.test_domain,
+                output=fm_mhm.OutputOptions(
+                    aggregate={"L1_AET": ("median", timedelta(days=1))}
+                ),
+            )
+        with self.assertRaises(ValueError):
+            fm_mhm.MHM(
+                cwd=self.test_domain,
+                coupling_step=timedelta(days=1),
+                output=fm_mhm.OutputOptions(
+                    aggregate={"L1_AET": ("mean", timedelta(hours=36))}
+                ),
+            )
+
+    def test_ensemble(self):
+        end_date = datetime(1990, 3, 1)
+        ensemble = fm_mhm.MHMEnsemble(
+            members=[dict(cwd=self.test_domain), dict(cwd=self.test_domain)],
+            outputs=["L1_TOTAL_RUNOFF"],
+            max_workers=2,
+        )
+        results = ensemble.run(end_time=end_date)
+
+        ref = np.genfromtxt(
+            self.here / "test_files/ref_runoff.csv",
+            names=True,
+            converters={0: str2date},
+            delimiter=",",
+            dtype=None,
+            encoding="utf-8",
+        )
+        ref = np.array([i[1] for i in ref])
+        for result in results:
+            self.assertEqual(result["time"][-1], end_date)
+            out = result["L1_TOTAL_RUNOFF"][:, 8, 4]
+            assert_allclose(ref[: len(out)], out)
+
+    def test_invalid_ensemble_outputs(self):
+        zones = fm_mhm.OutputOptions(zones={"all": ([np.arange(4)], ["L1_AET"])})
+        # outputs are checked before any member is run
+        fm_mhm.MHMEnsemble(
+            members=[dict(cwd=self.test_domain, output=zones)],
+            outputs=["L1_AET_ZONE_all", "L1_SOILMOIST_L01", "L11_QMOD_ZONE_GAUGES"],
+        )
+        for outputs in (["L1_UNKNOWN"], ["L1_AET_ZONE_all"], ["L1_SOILMOIST"]):
+            with self.assertRaises(ValueError):
+                fm_mhm.MHMEnsemble(
+                    members=[dict(cwd=self.test_domain)], outputs=outputs
+                )
+
+    def test_remote(self):
+        start_date = datetime(1990, 1, 1)
+        end_date = datetime(1990, 3, 1)
+        path = self.temp_path() / "runoff_remote_out.csv"
+
+        mhm = fm_mhm.RemoteMHM(cwd=self.test_domain)
+        csv = fm.components.CsvWriter(
+            path=path,
+            inputs=["Runoff"],
+            time_column="Time",
+            separator=",",
+            start=start_date,
+            step=timedelta(hours=1),
+        )
+
+        composition = fm.Composition([mhm, csv])
+
+        (
+            mhm.outputs["L1_TOTAL_RUNOFF"]
+            >> fm.adapters.GridToValue(func=lambda x: x[0, 8, 4])
+            >> csv["Runoff"]
+        )
+
+        composition.run(start_time=start_date, end_time=end_date)
+
+        ref = np.genfromtxt(
+            self.here / "test_files/ref_runoff.csv",
+            names=True,
+            converters={0: str2date},
+            delimiter=",",
+            dtype=None,
+            encoding="utf-8",
+        )
+        ref = np.array([i[1] for i in ref])
+        out = np.genfromtxt(
+            path,
+            names=True,
+            converters={0: str2date},
+            delimiter=",",
+            dtype=None,
+            encoding="utf-8",
+        )
+        out = np.array([i[1] for i in out])
+
+        assert_allclose(ref[: len(out)], out)
+
+    @unittest.skipIf(netCDF4 is None, "netCDF4 not installed")
+    def test_remote_files(self):
+        start_date = datetime(1990, 1, 1)
+        end_date = datetime(1990, 1, 11)
+
+        times, lengths = [], []
+        for component in [fm_mhm.MHM, fm_mhm.RemoteMHM]:
+            with tempfile.TemporaryDirectory() as tmp:
+                tmp = Path(tmp)
+                mhm = component(
+                    cwd=self.test_domain,
+                    coupling_step=timedelta(days=1),
+                    output=fm_mhm.OutputOptions(
+                        file=tmp / "mhm_out.nc", file_names=["L1_TOTAL_RUNOFF"]
+                    ),
+                    restart=fm_mhm.RestartOptions(write=tmp / "state"),
+                )
+                self.run_mhm(mhm, start_date, end_date, timedelta(days=1))
+                times.append((tmp / "state" / "time.txt").read_text(encoding="utf-8"))
+                with netCDF4.Dataset(tmp / "mhm_out.nc") as file:
+                    lengths.append(len(file["time"]))
+
+        # the worker doesn't run past the end of the composition
+        self.assertEqual(times, [end_date.isoformat()] * 2)
+        self.assertEqual(lengths[1], lengths[0])
+
+    def test_profile(self):
+        start_date = datetime(1990, 1, 1)
+        end_date = datetime(1990, 1, 2)
+        path = self.temp_path() / "aet_profile_out.csv"
+
+        mhm = fm_mhm.MHM(cwd=self.test_domain, profile=fm_mhm.ProfileOptions())
+        csv = fm.components.CsvWriter(
+            path=path,
+            inputs=["AET"],
+            time_column="Time",
+            separator=",",
+            start=start_date,
+            step=timedelta(hours=1),
+        )
+
+        composition = fm.Composition([mhm, csv])
+
+        (
+            mhm.outputs["L1_AET"]
+            >> fm.adapters.GridToValue(func=lambda x: x[0, 8, 4])
+            >> csv["AET"]
+        )
+
+        composition.run(start_time=start_date, end_time=end_date)
+
+        stats = mhm.profile_stats()
+        self.assertEqual(stats["do_time_step"]["count"], 24)
+        self.assertEqual(stats["push:L1_AET"]["count"], 24)
+        self.assertIn("calc:L1_AET", stats)
+        self.assertGreater(stats["update"]["time"], 0.0)
+
+    def test_calc_outputs(self):
+        start_date = datetime(1990, 1, 1)
+        end_date = datetime(1990, 1, 3)
+        names = [
+            "L1_AET",
+            "L1_AET_L01",
+            "L1_AET_L02",
+            "L1_SOIL_INFIL_L01",
+            "L1_SOIL_INFIL_L02",
+        ]
+        checked = []
+
+        def get(name, index=1):
+            return mhm.get_variable(name, index=index, compressed=True)
+
+        def reference(name):
+            # formulas of the derived outputs evaluated horizon by horizon
+            fsealed = get("L1_FSEALED")
+            fnotsealed = get("L1_FNOTSEALED")
+            if name == "L1_AET":
+                horizons = range(1, mhm.get.number_of_horizons() + 1)
+                aetsoil = sum(get("L1_AETSOIL", index=n) for n in horizons)
+                aetcanopy = get("L1_AETCANOPY")
+                return aetsoil * fnotsealed + aetcanopy + get("L1_AETSEALED") * fsealed
+            var, horizon = name[:-4], int(name[-2:])
+            source = {"L1_AET": "L1_AETSOIL", "L1_SOIL_INFIL": "L1_INFILSOIL"}[var]
+            return get(source, index=horizon) * fnotsealed
+
+        def check(name, data, _time):
+            assert_allclose(data.magnitude[0], reference(name), rtol=1e-12)
+            checked.append(name)
+
+        model = fm_mhm.MHM(
+            cwd=self.test_domain, output=fm_mhm.OutputOptions(compressed=True)
+        )
+        consumer = fm.components.DebugConsumer(
+            inputs={name: fm.Info(time=None, grid=None, units=None) for name in names},
+            start=start_date,
+            step=timedelta(hours=1),
+            callbacks={name: check for name in names},
+        )
+
+        composition = fm.Composition([model, consumer])
+
+        for name in names:
+            model.outputs[name] >> consumer.inputs[name]
+
+        composition.run(start_time=start_date, end_time=end_date)
+
+        self.assertEqual(len(checked), 49 * len(names))
+
+    def test_variable_cache(self):
+        start_date = datetime(1990, 1, 1)
+        end_date = datetime(1990, 1, 3)
+        names = list(fm_mhm.OUTPUT_CALC_META) + ["L1_AET_L01", "L1_SOIL_INFIL_L01"]
+        calls = []
+        get_variable = mhm.get_variable
+
+        def get(name, index=1, **kwargs):
+            calls.append((mhm.run.current_time(), name, index))
+            return get_variable(name, index=index, **kwargs)
+
+        model = fm_mhm.MHM(cwd=self.test_domain)
+        consumer = fm.components.DebugConsumer(
+            inputs={name: fm.Info(time=None, grid=None, units=None) for name in names},
+            start=start_date,
+            step=timedelta(hours=1),
+        )
+
+        composition = fm.Composition([model, consumer])
+
+        for name in names:
+            model.outputs[name] >> consumer.inputs[name]
+
+        with mock.patch("mhm.get_variable", side_effect=get):
+            composition.run(start_time=start_date, end_time=end_date)
+
+        # derived outputs share the variables fetched in a time-step
+        self.assertEqual(len(calls), len(set(calls)))
+        self.assertEqual(len({call[0] for call in calls}), 49)
+        self.assertIn("L1_FNOTSEALED", {call[1] for call in calls})
+
+    def test_unlinked_outputs(self):
+        start_date = datetime(1990, 1, 1)
+        end_date = datetime(1990, 1, 3)
+
+        model = fm_mhm.MHM(cwd=self.test_domain)
+        consumer = fm.components.DebugConsumer(
+            inputs={"Runoff": fm.Info(time=None, grid=None, units=None)},
+            start=start_date,
+            step=timedelta(hours=1),
+        )
+
+        composition = fm.Composition([model, consumer])
+
+        model.outputs["L1_TOTAL_RUNOFF"] >> consumer.inputs["Runoff"]
+        funcs = model.output_data
+        for name, func in funcs.items():
+            funcs[name] = mock.Mock(wraps=func)
+
+        composition.run(start_time=start_date, end_time=end_date)
+
+        # only the linked output is evaluated, also when connecting
+        self.assertEqual(funcs.pop("L1_TOTAL_RUNOFF").call_count, 49)
+        self.assertGreater(len(funcs), 0)
+        for func in funcs.values():
+            func.assert_not_called()
+
+    def test_compressed(self):
+        start_date = datetime(1990, 1, 1)
+        end_date = datetime(1990, 3, 1)
+        path = self.temp_path() / "runoff_compressed_out.csv"
+
+        mhm = fm_mhm.MHM(
+            cwd=self.test_domain, output=fm_mhm.OutputOptions(compressed=True)
+        )
+        csv = fm.components.CsvWriter(
+            path=path,
+            inputs=["Runoff"],
+            time_column="Time",
+            separator=",",
+            start=start_date,
+            step=timedelta(hours=1),
+        )
+
+        composition = fm.Composition([mhm, csv])
+
+        mask = mhm.masks["L1"]
+        cell = np.flatnonzero(~mask).tolist().index(8 * mask.shape[1] + 4)
+        self.assertIsInstance(
+            mhm.outputs["L1_TOTAL_RUNOFF"].info.grid, fm.UnstructuredPoints
+        )
+        (
+            mhm.outputs["L1_TOTAL_RUNOFF"]
+            >> fm.adapters.GridToValue(func=lambda x: x[0, cell])
+            >> csv["Runoff"]
+        )
+
+        composition.run(start_time=start_date, end_time=end_date)
+
+        ref = np.genfromtxt(
+            self.here / "test_files/ref_runoff.csv",
+            names=True,
+            converters={0: str2date},
+            delimiter=",",
+            dtype=None,
+            encoding="utf-8",
+        )
+        ref = np.array([i[1] for i in ref])
+        out = np.genfromtxt(
+            path,
+            names=True,
+            converters={0: str2date},
+            delimiter=",",
+            dtype=None,
+            encoding="utf-8",
+        )
+        out = np.array([i[1] for i in out])
+
+        assert_allclose(ref[: len(out)], out)
+
+    def test_reuse_buffers(self):
+        start_date = datetime(1990, 1, 1)
+        end_date = datetime(1990, 3, 1)
+        path = self.temp_path() / "runoff_buffers_out.csv"
+
+        mhm = fm_mhm.MHM(
+            cwd=self.test_domain, output=fm_mhm.OutputOptions(reuse_buffers=True)
+        )
+        csv = fm.components.CsvWriter(
+            path=path,
+            inputs=["Runoff"],
+            time_column="Time",
+            separator=",",
+            start=start_date,
+            step=timedelta(days=1),
+        )
+
+        composition = fm.Composition([mhm, csv])
+
+        (
+            mhm.outputs["L1_TOTAL_RUNOFF"]
+            >> fm.adapters.GridToValue(func=lambda x: x[0, 8, 4])
+            >> csv["Runoff"]
+        )
+
+        composition.run(start_time=start_date, end_time=end_date)
+
+        # buffers are only reused after the daily pulls released them
+        self.assertLessEqual(len(mhm.output.buffers["L1_TOTAL_RUNOFF"].buffers), 26)
+        ref = np.genfromtxt(
+            self.here / "test_files/ref_runoff.csv",
+            names=True,
+            converters={0: str2date},
+            delimiter=",",
+            dtype=None,
+            encoding="utf-8",
+        )
+        ref = np.array([i[1] for i in ref])[::24]
+        out = np.genfromtxt(
+            path,
+            names=True,
+            converters={0: str2date},
+            delimiter=",",
+            dtype=None,
+            encoding="utf-8",
+        )
+        out = np.array([i[1] for i in out])
+
+        assert_allclose(ref[: len(out)], out)
+
+    def test_zones(self):
+        start_date = datetime(1990, 1, 1)
+        end_date = datetime(1990, 3, 1)
+        path = self.temp_path() / "runoff_zone_out.csv"
+
+        # zone with a single cell
+        mhm = fm_mhm.MHM(
+            cwd=self.test_domain,
+            output=fm_mhm.OutputOptions(
+                zones={"cell": ([[(8, 4)]], ["L1_TOTAL_RUNOFF"])}
+            ),
+        )
+        csv = fm.components.CsvWriter(
+            path=path,
+            inputs=["Runoff"],
+            time_column="Time",
+            separator=",",
+            start=start_date,
+            step=timedelta(hours=1),
+        )
+
+        composition = fm.Composition([mhm, csv])
+
+        (
+            mhm.outputs["L1_TOTAL_RUNOFF_ZONE_cell"]
+            >> fm.adapters.GridToValue(func=lambda x: x[0, 0])
+            >> csv["Runoff"]
+        )
+
+        composition.run(start_time=start_date, end_time=end_date)
+
+        ref = np.genfromtxt(
+            self.here / "test_files/ref_runoff.csv",
+            names=True,
+            converters={0: str2date},
+            delimiter=",",
+            dtype=None,
+            encoding="utf-8",
+        )
+        ref = np.array([i[1] for i in ref])
+        out = np.genfromtxt(
+            path,
+            names=True,
+            converters={0: str2date},
+            delimiter=",",
+            dtype=None,
+            encoding="utf-8",
+        )
+        out = np.array([i[1] for i in out])
+
+        assert_allclose(ref[: len(out)], out)
+
+    def test_gauges(self):
+        start_date = datetime(1990, 1, 1)
+        end_date = datetime(1990, 1, 10)
+
+        model = fm_mhm.MHM(cwd=self.test_domain)
+        data = {"gauges": [], "eval": []}
+
+        def collect(_name, values, time):
+            data["gauges"].append(values.magnitude[0])
+            if time == end_date:
+                # simulated discharge at the gauges as evaluated by mRM
+                for index in range(len(model.gauge_ids)):
+                    data["eval"].append(mhm.get_runoff_eval(index + 1)[:, 0])
+
+        consumer = fm.components.DebugConsumer(
+            inputs={"gauges": fm.Info(time=None, grid=None, units=None)},
+            start=start_date,
+            step=timedelta(hours=1),
+            callbacks={"gauges": collect},
+        )
+
+        composition = fm.Composition([model, consumer])
+
+        model.outputs["L11_QMOD_ZONE_GAUGES"] >> consumer.inputs["gauges"]
+
+        composition.run(start_time=start_date, end_time=end_date)
+
+        self.assertGreater(len(model.gauge_ids), 0)
+        # daily means of the hourly discharge after the start time
+        hourly = np.array(data["gauges"][1:])
+        daily = hourly.reshape((-1, 24, len(model.gauge_ids))).mean(axis=1)
+        evaluated = np.array(data["eval"]).T[: len(daily)]
+        assert_allclose(daily, evaluated)
+
+        # gauges on inactive cells are skipped
+        __, cells = model._find_gauges()
+        mask = model.masks["L11"].copy()
+        mask.flat[np.concatenate(cells)] = True
+        model.masks["L11"] = mask
+        self.assertEqual(model._find_gauges(), ([], []))
+
+    def test_meteo_prefetch(self):
+        start_date = datetime(1990, 1, 1)
+        end_date = datetime(1990, 1, 11)
+
+        results = []
+        for prefetch in [None, 4]:
+            mhm = fm_mhm.MHM(
+                cwd=self.test_domain,
+                input_names=["METEO_PRE"],
+                meteo_timestep=24,
+                ignore_input_grid=True,
+                coupling_step=timedelta(days=2),
+                meteo=fm_mhm.MeteoOptions(prefetch=prefetch),
+            )
+            pre = self.daily_pre(
+                start_date, lambda t: np.full(mhm.masks["L1"].shape, float(t.day))
+            )
+            step = timedelta(days=2)
+            results.append(self.run_mhm(mhm, start_date, end_date, step, inputs=[pre]))
+
+        assert_allclose(results[0], results[1])
+
+    def test_meteo_files(self):
+        start_date = datetime(1990, 1, 1)
+        end_date = datetime(1990, 1, 11)
+        pre_file = self.temp_path() / "pre.npy"
+        step = timedelta(days=1)
+
+        results = []
+        for from_file in [False, True]:
+            if from_file:
+                mhm = fm_mhm.MHM(
+                    cwd=self.test_domain,
+                    meteo=fm_mhm.MeteoOptions(files={"METEO_PRE": pre_file}),
+                    meteo_timestep=24,
+                )
+                results.append(self.run_mhm(mhm, start_date, end_date, step))
+            else:
+                mhm = fm_mhm.MHM(
+                    cwd=self.test_domain,
+                    input_names=["METEO_PRE"],
+                    meteo_timestep=24,
+                    ignore_input_grid=True,
+                )
+                pre = self.daily_pre(
+                    start_date, lambda t: np.full(mhm.masks["L1"].shape, float(t.day))
+                )
+                results.append(
+                    self.run_mhm(mhm, start_date, end_date, step, inputs=[pre])
+                )
+                # same precipitation as file for the second run
+                days = np.arange(1, 11, dtype=float)[:, np.newaxis, np.newaxis]
+                np.save(pre_file, days * np.ones(mhm.masks["L1"].shape))
+
+        assert_allclose(results[0], results[1])
+
+    def test_meteo_options(self):
+        # input names are case-insensitive as for coupled inputs
+        options = fm_mhm.MeteoOptions(files={"meteo_pre": "pre.npy"})
+        self.assertEqual(options.files, {"METEO_PRE": "pre.npy"})
+        with self.assertRaises(ValueError):
+            fm_mhm.MeteoOptions(files={"PRE": "pre.npy"})
+
+    def test_cwd(self):
+        start_date = datetime(1990, 1, 1)
+        end_date = datetime(1990, 1, 3)
+
+        cwds = []
+        mhm = fm_mhm.MHM(cwd=self.test_domain)
+        consumer = fm.components.DebugConsumer(
+            inputs={"Runoff": fm.Info(time=None, grid=None, units=None)},
+            start=start_date,
+            step=timedelta(hours=1),
+            callbacks={"Runoff": lambda _c, _d, _t: cwds.append(os.getcwd())},
+        )
+        # mHM is initialized in its working directory by the composition
+        composition = fm.Composition([mhm, consumer])
+        mhm.outputs["L1_TOTAL_RUNOFF"] >> consumer.inputs["Runoff"]
+        self.assertEqual(os.getcwd(), str(self.here))
+
+        # the working directory is never changed while running
+        with mock.patch("os.chdir") as chdir:
+            composition.run(start_time=start_date, end_time=end_date)
+        chdir.assert_not_called()
+        self.assertEqual(mhm.time, end_date)
+        self.assertEqual(set(cwds), {str(self.here)})
+
+    def test_meteo_conversion(self):
+        start_date = datetime(1990, 1, 1)
+        end_date = datetime(1990, 1, 11)
+
+        results = []
+        for units, scale in [("mm / d", 1.0), ("mm / h", 1 / 24)]:
+            mhm = fm_mhm.MHM(
+                cwd=self.test_domain,
+                input_names=["METEO_PRE"],
+                meteo_timestep=24,
+                ignore_input_grid=True,
+            )
+            pre = self.daily_pre(
+                start_date,
+                lambda t, s=scale: np.full(mhm.masks["L1"].shape, t.day * s),
+                units=units,
+            )
+            step = timedelta(days=1)
+            results.append(self.run_mhm(mhm, start_date, end_date, step, inputs=[pre]))
+            self.assertAlmostEqual(mhm.meteo.conversions["METEO_PRE"].factor, 1 / scale)
+
+        assert_allclose(results[0], results[1])
+
+    def test_meteo_regrid(self):
+        start_date = datetime(1990, 1, 1)
+        end_date = datetime(1990, 1, 11)
+
+        cache = self.temp_path() / "regrid_cache"
+
+        results = []
+        grid, factor = None, None
+        for refine in [1, 2]:
+            mhm = fm_mhm.MHM(
+                cwd=self.test_domain,
+                input_names=["METEO_PRE"],
+                meteo_timestep=24,
+                ignore_input_grid=refine == 1,
+                meteo=fm_mhm.MeteoOptions(regrid=refine > 1),
+                cache=fm_mhm.CacheOptions(regrid=cache),
+            )
+            if refine > 1:
+                # L1 grid with refined cells (known from the first run)
+                grid = fm.EsriGrid(
+                    ncols=grid.ncols * refine,
+                    nrows=grid.nrows * refine,
+                    cellsize=grid.cellsize / refine,
+                    xllcorner=grid.xllcorner,
+                    yllcorner=grid.yllcorner,
+                )
+            pre = self.daily_pre(
+                start_date,
+                lambda t, r=refine: t.day * np.kron(factor, np.ones((r, r))),
+                grid=grid,
+            )
+            out = []
+            consumer = fm.components.DebugConsumer(
+                inputs={"Runoff": fm.Info(time=None, grid=None, units=None)},
+                start=start_date,
+                step=timedelta(days=1),
+                callbacks={"Runoff": lambda _c, d, _t: out.append(d[0, 8, 4])},
+            )
+            composition = fm.Composition([mhm, pre, consumer])
+            pre.outputs["METEO_PRE"] >> mhm.inputs["METEO_PRE"]
+            mhm.outputs["L1_TOTAL_RUNOFF"] >> consumer.inputs["Runoff"]
+            if refine == 1:
+                grid = mhm.gridspec["L1"]
+                factor = 1.0 + np.arange(grid.data_size).reshape(grid.data_shape) % 3
+            composition.run(start_time=start_date, end_time=end_date)
+            results.append(np.array([v.magnitude for v in out]))
+
+        assert_allclose(results[0], results[1])
+        self.assertEqual(len(list(cache.glob("*.npz"))), 1)
+
+    def test_meteo_mask(self):
+        start_date = datetime(1990, 1, 1)
+        end_date = datetime(1990, 1, 3)
+
+        mhm = fm_mhm.MHM(cwd=self.test_domain)
+        mhm.initialize()
+        grid, mask = mhm.gridspec["L1"], mhm.masks["L1"]
+        mhm.finalize()
+        # precipitation masked at the active cell (8, 4)
+        pre_mask = mask.copy()
+        pre_mask[8, 4] = True
+
+        # masks of the info are checked when connecting, flexible masks on the first pull
+        for info_mask in [pre_mask, fm.Mask.FLEX]:
+            mhm = fm_mhm.MHM(
+                cwd=self.test_domain, input_names=["METEO_PRE"], meteo_timestep=24
+            )
+            pre = self.daily_pre(
+                start_date,
+                lambda _t: np.ma.array(np.ones(mask.shape), mask=pre_mask),
+                grid=grid,
+                mask=info_mask,
+            )
+            with self.assertRaises(ValueError):
+                self.run_mhm(mhm, start_date, end_date, timedelta(days=1), inputs=[pre])
+            mhm.finalize()
+
+    def test_restart(self):
+        start_date = datetime(1990, 1, 1)
+        restart_date = datetime(1990, 3, 1)
+        end_date = datetime(1990, 3, 11)
+        state = self.temp_path() / "state"
+        step = timedelta(days=1)
+
+        # continuous run over the whole period
+        mhm = fm_mhm.MHM(cwd=self.test_domain)
+        ref = self.run_mhm(mhm, start_date, end_date, step)
+
+        # same period split at the saved state
+        mhm = fm_mhm.MHM(
+            cwd=self.test_domain, restart=fm_mhm.RestartOptions(write=state)
+        )
+        first = self.run_mhm(mhm, start_date, restart_date, step)
+        self.assertEqual(mhm.time, restart_date)
+        self.assertTrue((state / "mHM_restart.nc").exists())
+
+        mhm = fm_mhm.MHM(
+            cwd=self.test_domain, restart=fm_mhm.RestartOptions(read=state)
+        )
+        second = self.run_mhm(mhm, restart_date, end_date, step)
+
+        assert_allclose(ref[: len(first)], first)
+        # fluxes at the time of the state are not restored
+        assert_allclose(ref[len(first) :], second[1:])
+
+    def test_restart_not_midnight(self):
+        state = self.temp_path() / "state"
+        mhm = fm_mhm.MHM(
+            cwd=self.test_domain, restart=fm_mhm.RestartOptions(write=state)
+        )
+        composition = fm.Composition([mhm])
+        with self.assertLogs(mhm.logger, level="WARNING"):
+            composition.run(
+                start_time=datetime(1990, 1, 1), end_time=datetime(1990, 1, 1, 12)
+            )
+        self.assertFalse((state / "time.txt").exists())
+        with self.assertRaises(ValueError):
+            fm_mhm.MHM(cwd=self.test_domain, restart=fm_mhm.RestartOptions(read=state))
+
+    def test_invalid_restart(self):
+        with self.assertRaises(ValueError):
+            fm_mhm.MHM(
+                cwd=self.test_domain,
+                restart=fm_mhm.RestartOptions(read=self.here / "no_state"),
+            )
+
+    def test_metadata_cache(self):
+        start_date = datetime(1990, 1, 1)
+        end_date = datetime(1990, 1, 11)
+        cache = self.temp_path() / "metadata_cache"
+
+        results, masks = [], []
+        for __ in range(2):
+            mhm = fm_mhm.MHM(
+                cwd=self.test_domain, cache=fm_mhm.CacheOptions(metadata=cache)
+            )
+            out = []
+            consumer = fm.components.DebugConsumer(
+                inputs={"Runoff": fm.Info(time=None, grid=None, units=None)},
+                start=start_date,
+                step=timedelta(days=1),
+                callbacks={"Runoff": lambda _c, d, _t: out.append(d[0, 8, 4])},
+            )
+            composition = fm.Composition([mhm, consumer])
+            mhm.outputs["L1_TOTAL_RUNOFF"] >> consumer.inputs["Runoff"]
+            composition.run(start_time=start_date, end_time=end_date)
+            results.append(np.array([v.magnitude for v in out]))
+            masks.append(mhm.masks["L1"])
+            self.assertEqual(len(list(cache.glob("metadata_*.pkl"))), 1)
+
+        assert_allclose(results[0], results[1])
+        np.testing.assert_array_equal(masks[0], masks[1])
+
+    def test_output_names(self):
+        mhm = fm_mhm.MHM(
+            cwd=self.test_domain,
+            output=fm_mhm.OutputOptions(names=["L11_QMOD", "L1_SOILMOIST_L*"]),
+        )
+        mhm.initialize()
+        horizons = [f"L1_SOILMOIST_L{n:02}" for n in mhm.horizons]
+        self.assertEqual(set(mhm.outputs), {"L11_QMOD", *horizons})
+        self.assertEqual(mhm.OUTPUT_NAMES, list(mhm.output_data))
+        mhm.finalize()
+
+    def test_output_names_zone(self):
+        mhm = fm_mhm.MHM(
+            cwd=self.test_domain,
+            output=fm_mhm.OutputOptions(
+                zones={"cell": ([[(8, 4)]], ["L1_TOTAL_RUNOFF"])},
+                names=["l1_total_runoff_zone_cell"],
+            ),
+        )
+        mhm.initialize()
+        self.assertEqual(set(mhm.outputs), {"L1_TOTAL_RUNOFF_ZONE_cell"})
+        mhm.finalize()
+
+    def test_invalid_output_names(self):
+        mhm = fm_mhm.MHM(
+            cwd=self.test_domain,
+            output=fm_mhm.OutputOptions(names=["L1_NOT_AVAILABLE"]),
+        )
+        with self.assertRaises(ValueError):
+            mhm.initialize()
+
+    def test_dtype(self):
+        start_date = datetime(1990, 1, 1)
+        end_date = datetime(1990, 1, 11)
+
+        results = []
+        for dtype in [None, {"L1_TOTAL_RUNOFF": "float32"}]:
+            mhm = fm_mhm.MHM(
+                cwd=self.test_domain, output=fm_mhm.OutputOptions(dtype=dtype)
+            )
+            out = []
+            consumer = fm.components.DebugConsumer(
+                inputs={"Runoff": fm.Info(time=None, grid=None, units=None)},
+                start=start_date,
+                step=timedelta(days=1),
+                callbacks={"Runoff": lambda _c, d, _t: out.append(d.magnitude)},
+            )
+            composition = fm.Composition([mhm, consumer])
+            mhm.outputs["L1_TOTAL_RUNOFF"] >> consumer.inputs["Runoff"]
+            composition.run(start_time=start_date, end_time=end_date)
+            results.append(np.array([v[0, 8, 4] for v in out]))
+            expected = np.float64 if dtype is None else np.float32
+            self.assertTrue(all(v.dtype == expected for v in out))
+        self.assertEqual(mhm.outputs["L1_TOTAL_RUNOFF"].info.meta["dtype"], "float32")
+        self.assertNotIn("dtype", mhm.outputs["L1_AET"].info.meta)
+
+        assert_allclose(results[0], results[1], rtol=1e-6)
+
+    def test_invalid_dtype(self):
+        with self.assertRaises(ValueError):
+            fm_mhm.OutputOptions(dtype="int32")
+
+    @unittest.skipIf(netCDF4 is None, "netCDF4 not installed")
+    def test_output_file(self):
+        start_date = datetime(1990, 1, 1)
+        end_date = datetime(1990, 1, 11)
+        path = self.temp_path() / "mhm_out.nc"
+
+        mhm = fm_mhm.MHM(
+            cwd=self.test_domain,
+            coupling_step=timedelta(days=1),
+            output=fm_mhm.OutputOptions(file=path, file_names=["L1_TOTAL_RUNOFF"]),
+        )
+        out = []
+        consumer = fm.components.DebugConsumer(
+            inputs={"Runoff": fm.Info(time=None, grid=None, units=None)},
+            start=start_date,
+            step=timedelta(days=1),
+            callbacks={"Runoff": lambda _c, d, _t: out.append(d[0].magnitude)},
+        )
+        composition = fm.Composition([mhm, consumer])
+        mhm.outputs["L1_TOTAL_RUNOFF"] >> consumer.inputs["Runoff"]
+        composition.run(start_time=start_date, end_time=end_date)
+
+        with netCDF4.Dataset(path) as file:
+            self.assertEqual(list(file.variables)[-1], "L1_TOTAL_RUNOFF")
+            self.assertEqual(file["time"][:].tolist(), list(range(0, 241, 24)))
+            assert_allclose(file["L1_TOTAL_RUNOFF"][:], np.ma.stack(out))
+
+    def test_invalid_coupling_step(self):
+        with self.assertRaises(ValueError):
+            fm_mhm.MHM(cwd=self.test_domain, coupling_step=timedelta(minutes=90))
+
 
 if __name__ == "__main__":
     unittest.main()